@@ -34,13 +34,13 @@ class CBTResponseStrategyEngine:
         }
 
     def selectstrategy(self, emotionalanalysis):
-        if emotionalanalysis["crisislevel"] == "high":
+        if emotionalanalysis.crisis:
             return "crisisintervention"
-        primaryemotions = emotionalanalysis.get("primaryemotions", [])
+        primaryemotions = emotionalanalysis.primary_emotions
         if "trauma" in primaryemotions: return "traumainformed"
         if "anxiety" in primaryemotions: return "anxietyfocused"
         if "depression" in primaryemotions: return "depressionfocused"
         if "relationships" in primaryemotions: return "relationshipfocused"
-        if emotionalanalysis.get("cognitivedistortions"):
+        if emotionalanalysis.distortion_bits:
             return "cognitiverestructuring"
         return "cognitiverestructuring"
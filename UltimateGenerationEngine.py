@@ -1,32 +1,195 @@
+import asyncio
+import logging
+import queue
+import random
+import re
+import statistics
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from transformers import StoppingCriteriaList
+
+from cbt_strategy_engine import CBTResponseStrategyEngine
+from emotional_intelligence_engine import EmotionalIntelligenceEngine
+from generation_scheduler import SamplingParams
+from kv_cache import SESSION_CACHE_BUDGET_BYTES, PrefixKVCache, SessionKVCache
+from prompt_assembler import PromptAssembler
+from rag_knowledge_engine import RAGKnowledgeEngine
+from safety_scanner import DEFAULT_STOP_SEQUENCES, StopSequenceScanner
+from session_manager import SessionManager
+from stopping_criteria import CancellationCriteria, ReplyStream, SafetyStoppingCriteria, stopped_text
+from turn_pipeline import StageGraph
+
+logger = logging.getLogger(__name__)
+
+# Crisis fast path: safety responses are rendered once per strategy at startup
+CRISIS_RESOURCES = [
+    "Emergency services: call your local emergency number (112 in India and Europe, 911 in the US)",
+    "India: Tele-MANAS, 14416 or 1-800-891-4416 (24/7)",
+    "US: call or text 988 (Suicide & Crisis Lifeline)",
+    "UK & Ireland: Samaritans, 116 123",
+]
+CRISIS_OPENING = (
+    "I'm really glad you told me, and I'm taking what you said seriously. "
+    "You don't have to go through this alone. If you are in immediate danger or think you might act "
+    "on these thoughts, please contact emergency services or a crisis line right now."
+)
+CRISIS_FOCUS_LINES = {
+    "anxiety_focused": "If your mind is racing, try breathing in slowly for four counts and out for six, a few times, while we talk.",
+    "depression_focused": "When everything feels heavy and hopeless, reaching out like this is a real act of strength.",
+    "trauma_informed": "If memories feel overwhelming right now, try naming five things you can see around you to stay grounded in the present.",
+    "relationship_focused": "Is there someone you trust, a friend or family member, who could be with you or talk with you right now?",
+    "cognitive_restructuring": "Right now, the most important thing is your safety.",
+}
+CRISIS_CLOSING = "Would you be willing to reach out to one of them, and can you tell me if you are safe right now?"
+
+# Fixed start of every generation prompt (its KV cache is precomputed, see PrefixKVCache)
+PROMPT_PREAMBLE = "You are a supportive CBT therapist. Continue the conversation naturally.\n"
+
+# Decoding settings of every reply, for model.generate and the batching scheduler alike
+GENERATION_SETTINGS = {
+    "max_new_tokens": 250,
+    "min_new_tokens": 70,
+    "do_sample": True,
+    "temperature": 0.7,
+    "top_p": 0.95,
+    "repetition_penalty": 1.2,
+}
+
+# phi-2's context window; the prompt gets what the longest reply leaves of it
+MODEL_CONTEXT_TOKENS = 2048
+PROMPT_TOKEN_BUDGET = MODEL_CONTEXT_TOKENS - GENERATION_SETTINGS["max_new_tokens"]
+
+
 class UltimateGenerationEngine:
-    def __init__(self, model, tokenizer): # Corrected __init__ method
+    def __init__(self, model, tokenizer, crisis_follow_up=False, scan_output=True, embedding_classifier=False,
+                 prefix_cache=True, session_cache=True, session_id=None,
+                 kv_budget_bytes=SESSION_CACHE_BUDGET_BYTES,
+                 stop_sequences=DEFAULT_STOP_SEQUENCES, max_sessions=1000, session_ttl=3600,
+                 session_memory_bytes=64 << 20, scheduler=None, stage_workers=4,
+                 prompt_token_budget=PROMPT_TOKEN_BUDGET): # Corrected __init__ method
         self.model = model
         self.tokenizer = tokenizer
+        # When True, generated text is scanned while it streams out of the model
+        # and generation stops at the first crisis keyword
+        self.scan_output = scan_output
+        # Generation halts as soon as the reply contains one of these (e.g. the
+        # model starting the next "User:" turn) instead of running to max_new_tokens
+        self.stop_sequences = stop_sequences
+        # Optional ContinuousBatchingScheduler or MicroBatchingScheduler shared by all sessions
+        # (and engines): replies are then decoded together in batches instead of one generate() each
+        self.scheduler = scheduler
+        # Thread pools (their threads start on first use): one for the stages of
+        # every turn (_turn_stages), and the inference worker every generation
+        # runs on. Without a scheduler the model runs one generation at a time;
+        # with one, each row of its batch needs a worker blocked in scheduler.generate()
+        self.stage_workers = stage_workers
+        self._stage_pool = ThreadPoolExecutor(stage_workers, thread_name_prefix="turn-stage")
+        self._inference_pool = ThreadPoolExecutor(
+            scheduler.max_batch_size if scheduler is not None else 1, thread_name_prefix="inference")
+        # When True, a crisis turn also starts a full RAG + LLM generation in the
+        # background and hands it to the on_follow_up callback
+        self.crisis_follow_up = crisis_follow_up
+        # "stages": per-turn (start, end) of every stage, see stage_summary();
+        # "prompt_tokens": length of every prompt, never above the token budget;
+        # "session_cache": prompt tokens taken from the previous turn's cache, see session_cache_summary()
+        self.latency_log = {"crisis_fast_path": deque(maxlen=1000), "generation": deque(maxlen=1000),
+                            "first_visible_text": deque(maxlen=1000), "stages": deque(maxlen=1000),
+                            "prompt_tokens": deque(maxlen=1000), "session_cache": deque(maxlen=1000)}
 
         # Make sure to initialize these if they are not globally available
         self.ei_engine = EmotionalIntelligenceEngine()
         self.strategy_engine = CBTResponseStrategyEngine()
-        self.conversation_memory = deque(maxlen=10)
+        # Per-user conversation memory and emotional state; the model and the
+        # engines above are shared by every session. Calls without a
+        # session_id use the engine's own default session.
+        self.sessions = SessionManager(max_sessions, session_ttl, session_memory_bytes,
+                                       on_evict=self._on_session_evicted)
+        self.session_id = session_id or uuid.uuid4().hex
 
         # RAG ADDITION: initialize RAG
         self.rag_engine = RAGKnowledgeEngine() # Using the renamed class
         self.rag_top_k = 4
+        # Optionally classify emotions from the RAG query embedding as well as keywords.
+        # Experimental and off by default: its thresholds are not calibrated yet
+        if embedding_classifier:
+            self.ei_engine.enable_embedding_classifier(self.rag_engine.embedding_fn)
+        self.crisis_responses = self._render_crisis_responses()
+
+        # Prompts are assembled from segments (prefix, turns, RAG snippets, message)
+        # within a hard token budget that also leaves room for the longest reply.
+        # The segments are tokenized by concurrent stages, and their ids are
+        # concatenated if that matches tokenizing the joined prompt.
+        context = getattr(getattr(model, "config", None), "max_position_embeddings", None) or MODEL_CONTEXT_TOKENS
+        self.assembler = PromptAssembler(
+            tokenizer, min(prompt_token_budget, context - GENERATION_SETTINGS["max_new_tokens"]))
+        self.assembler.check_chat_segments(self._prompt_prefix(None))
+
+        # Keys/values of the fixed prompt prefix of every strategy, computed once
+        self.prefix_cache = None
+        if prefix_cache and scheduler is None:
+            self.prefix_cache = PrefixKVCache(model, tokenizer)
+            self.prefix_cache.warm(self._prompt_prefix(s) for s in self.strategy_engine.therapy_approaches)
+
+        # Keys/values of the previous turn, extended instead of re-prefilling the history.
+        # Pass a SessionKVCache to share one memory budget between several engines.
+        self.session_cache = None
+        if isinstance(session_cache, SessionKVCache):
+            self.session_cache = session_cache
+        elif session_cache:
+            self.session_cache = SessionKVCache(kv_budget_bytes)
+
+    @property
+    def conversation_memory(self):
+        """Prompt history of the default session."""
+        return self.sessions.get(self.session_id).memory
+
+    @property
+    def conversation_state(self):
+        """ConversationStateTracker of the default session."""
+        return self.sessions.get(self.session_id).state
+
+    def _on_session_evicted(self, session_id):
+        if self.session_cache is not None:
+            self.session_cache.drop(session_id)
+
+    def _render_crisis_responses(self):
+        """
+        Pre-render one safety response per strategy in therapy_approaches. The
+        strategy is the one the message would get without the crisis override,
+        so the grounding line can match what the user is going through.
+        """
+        resources = "\n".join(f"- {line}" for line in CRISIS_RESOURCES)
+        default_line = CRISIS_FOCUS_LINES["cognitive_restructuring"]
+        return {
+            strategy: f"{CRISIS_OPENING} {CRISIS_FOCUS_LINES.get(strategy, default_line)}\n\n"
+                      f"Support you can contact right now:\n{resources}\n\n{CRISIS_CLOSING}"
+            for strategy in self.strategy_engine.therapy_approaches
+        }
+
+    def _prompt_prefix(self, strategy=None):
+        """
+        The part of the prompt that is fixed for a strategy. The inference
+        prompt has no strategy-specific instructions yet, so every strategy
+        currently shares the preamble (and a single cache entry).
+        """
+        return PROMPT_PREAMBLE
 
-    def _format_rag_knowledge(self, docs):
-        if not docs:
-            return ""
+    def _rag_snippets(self, docs):
         snippets = []
-        for d in docs:
+        for d in docs or []:
             if not d or 'content' not in d: # Check if doc is valid and has 'content'
                 continue
             # safe limit per document to keep prompt under control
             snippet = d['content'].strip().replace("\n", " ")
             if len(snippet) > 600:
                 snippet = snippet[:600] + "..."
-            snippets.append(f"- {snippet}")
-        if not snippets:
-            return ""
-        return "Relevant Knowledge (use if helpful, otherwise ignore):\n" + "\n".join(snippets) + "\n"
+            snippets.append(snippet)
+        return snippets
 
 
     def post_process_response(self, response):
@@ -34,21 +197,13 @@ class UltimateGenerationEngine:
         This is the POLISHING function. It cleans the raw output from the model.
         """
         # Step 1: Get the core response by splitting at the first sign of an artifact
-        stop_tokens = ["<|", "</", "[/", "<&", "User:", "Therapist:", "CLINICAL ASSESSMENT", "QUALITY VERIFICATION", "###"]
-        for token in stop_tokens:
+        # (generation normally stops at these already, see SafetyStoppingCriteria)
+        for token in self.stop_sequences or DEFAULT_STOP_SEQUENCES:
             if token in response:
                 response = response.split(token)[0].strip()
 
         # Step 2: Handle sentence structure and capitalization
-        sentences = re.split(r'(?<=[.!?])\s+', response)
-        clean_sentences = []
-        for sentence in sentences:
-            sentence = sentence.strip()
-            if sentence:
-                if not sentence[0].isupper():
-                    sentence = sentence[0].upper() + sentence[1:]
-                clean_sentences.append(sentence)
-        response = ' '.join(clean_sentences)
+        response = self._format_sentences(response)
 
         if not response:
             return "I'm not sure how to respond to that. Could you please tell me more?"
@@ -61,57 +216,436 @@ class UltimateGenerationEngine:
 
         return response
 
-    def generate_master_response(self, user_input):
+    def _format_sentences(self, response):
+        # Capitalize every sentence and join them with single spaces. Also applied
+        # to the partial reply while streaming, so it must work on any prefix.
+        sentences = re.split(r'(?<=[.!?])\s+', response)
+        clean_sentences = []
+        for sentence in sentences:
+            sentence = sentence.strip()
+            if sentence:
+                if not sentence[0].isupper():
+                    sentence = sentence[0].upper() + sentence[1:]
+                clean_sentences.append(sentence)
+        return ' '.join(clean_sentences)
+
+    def generate_master_response(self, user_input, on_follow_up=None, session_id=None):
         """
         CHANGED: This function now uses conversation memory to provide context.
         REASON: To create more natural, flowing conversations where the agent
         remembers what was said before.
+
+        Crisis messages never wait for RAG or the LLM: the keyword screen runs
+        before VADER and everything else, and a pre-rendered safety response is
+        returned immediately, even while another turn of the same session is
+        still generating. If crisis_follow_up is enabled and on_follow_up is
+        given, a full generation runs in the background and is passed to
+        on_follow_up(text) when it finishes.
+
+        session_id selects the conversation (see SessionManager); turns of one
+        session run one at a time, different sessions concurrently. The session
+        is pinned for the whole turn, so it is never evicted under a running turn.
+        Decoding runs on the engine's inference worker in every path, so the
+        model generates one reply at a time (one batch with a scheduler).
+        """
+        start = time.perf_counter()
+        session = self.sessions.get(session_id or self.session_id, pin=True)
+        try:
+            screen = self.ei_engine.screen_message(user_input)
+            if screen.crisis:
+                return self._crisis_response(session, user_input, screen, start, on_follow_up)
+
+            with session.lock:
+                graph = self._turn_stages(session, user_input)
+                analysis, strategy, _ = graph.result("analysis")
+                polished_response = self._inference_pool.submit(
+                    self._decode_turn, graph, user_input, session, graph.result("prompt")).result()
+                self._remember_turn(session, user_input, polished_response, analysis, start)
+                return polished_response, analysis, strategy
+        finally:
+            self.sessions.unpin(session)
+
+    def generate_master_response_stream(self, user_input, on_follow_up=None, session_id=None):
+        """
+        Streaming variant of generate_master_response for chat UIs (see
+        chat_ui.py). A generator that yields the polished reply so far, the
+        whole text each time, while the model is still generating. Sentences
+        are capitalized as they appear and stop sequences never reach the
+        screen. The last value yielded is the final polished response, exactly
+        what generate_master_response returns for the same generated text.
+
+        Crisis turns yield the pre-rendered safety response at once. The time
+        to the first visible text is recorded in latency_log["first_visible_text"].
+
+        If the generator is closed early (e.g. Gradio drops it when the client
+        disconnects, or it is garbage-collected), generation stops before its
+        next token, the turn is not remembered and the session is unlocked.
+        """
+        start = time.perf_counter()
+        session = self.sessions.get(session_id or self.session_id, pin=True)
+        cancelled = threading.Event()
+        locked = False
+        worker = None
+        try:
+            screen = self.ei_engine.screen_message(user_input)
+            if screen.crisis:
+                yield self._crisis_response(session, user_input, screen, start, on_follow_up)[0]
+                return
+
+            session.lock.acquire()
+            locked = True
+            graph = self._turn_stages(session, user_input)
+            analysis, strategy, _ = graph.result("analysis")
+            prompt = graph.result("prompt")
+            # generate() runs on the inference worker, hands over the displayable text
+            # and remembers the turn. Once submitted it owns the session lock and pin,
+            # so the session stays locked until the turn is remembered or cancelled.
+            updates, result = queue.Queue(), {}
+
+            def generate():
+                try:
+                    response = self._decode_turn(graph, user_input, session, prompt, on_text=updates.put,
+                                                 cancelled=cancelled)
+                    if response is not None:
+                        self._remember_turn(session, user_input, response, analysis, start)
+                    result["response"] = response
+                except Exception as exc:
+                    result["error"] = exc
+                finally:
+                    self._end_turn(session)
+                    updates.put(None)
+
+            worker = self._inference_pool.submit(generate)
+            shown = ""
+            while True:
+                text = updates.get()
+                if text is None:
+                    break
+                partial = self._format_sentences(text)
+                if partial and partial != shown:
+                    if not shown:
+                        self.latency_log["first_visible_text"].append(time.perf_counter() - start)
+                    shown = partial
+                    yield partial
+            if "error" in result:
+                raise result["error"]
+
+            polished_response = result["response"]
+            if polished_response != shown:
+                yield polished_response
+        finally:
+            # Closed before the end (GeneratorExit): stop the worker before its next token
+            cancelled.set()
+            if worker is None:
+                self._end_turn(session, locked)
+
+    async def agenerate(self, session_id, text):
+        """
+        Asyncio version of generate_master_response, for async web front ends.
+        Returns the same (response, analysis, strategy) tuple.
+
+        The event loop is never blocked. The turn's stages (see _turn_stages)
+        run in a thread pool, and generation is handed to the inference worker
+        shared by every path, see _generate_reply(). If the awaiting task is
+        cancelled, e.g. because the client disconnected, generation stops
+        before its next token. A request still queued for the worker or the
+        scheduler is never prefilled, and the turn is not remembered.
+        """
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        session = self.sessions.get(session_id or self.session_id, pin=True)
+        locked = False
+        try:
+            screen = self.ei_engine.screen_message(text)
+            if screen.crisis:
+                return self._crisis_response(session, text, screen, start)
+            await _acquire(session.lock)
+            locked = True
+        finally:
+            if not locked:
+                self.sessions.unpin(session)
+        cancelled = threading.Event()
+        # Work handed to the pools keeps running after a cancelled await, so the
+        # session is only unlocked and unpinned once all of it has finished
+        futures = []
+
+        def run(pool, fn, *args, **kwargs):
+            future = pool.submit(fn, *args, **kwargs)
+            futures.append(future)
+            return asyncio.wrap_future(future, loop=loop)
+
+        try:
+            graph = self._turn_stages(session, text)
+            futures.extend(graph.futures.values())
+            (analysis, strategy, _), prompt = await asyncio.gather(
+                asyncio.wrap_future(graph.futures["analysis"], loop=loop),
+                asyncio.wrap_future(graph.futures["prompt"], loop=loop))
+            polished_response = await run(
+                self._inference_pool, self._decode_turn, graph, text, session, prompt, cancelled=cancelled)
+            self._remember_turn(session, text, polished_response, analysis, start)
+            return polished_response, analysis, strategy
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+        finally:
+            _call_after(lambda: self._end_turn(session), futures)
+
+    def _analyze_turn(self, session, user_input, query_embedding=None):
+        # The message is embedded once and shared by the classifier and retrieval
+        if query_embedding is None and self.ei_engine.classifier is not None:
+            query_embedding = self.rag_engine.embed_query(user_input)
+        analysis = self.ei_engine.analyze_emotional_state(user_input, embedding=query_embedding)
+        # The state is only updated when the turn is remembered, so a cancelled turn leaves no trace
+        strategy = self.strategy_engine.select_strategy(analysis, session.state.preview(analysis))
+        return analysis, strategy, query_embedding
+
+    def _remember_turn(self, session, user_input, response, analysis, start):
+        # Add the current turn to memory and its analysis to the emotional state
+        session.remember(user_input, response, analysis)
+        self.latency_log["generation"].append(time.perf_counter() - start)
+
+    def _end_turn(self, session, locked=True):
+        if locked:
+            session.lock.release()
+        self.sessions.unpin(session)
+
+    def _crisis_response(self, session, user_input, screen, start, on_follow_up=None):
+        focus = self.strategy_engine.select_strategy(screen.replace(crisis=False), session.state.preview(screen))
+        response = self.crisis_responses[focus]
+        history_turns = session.turns()
+        session.remember(user_input, response, screen)
+
+        latency = time.perf_counter() - start
+        self.latency_log["crisis_fast_path"].append(latency)
+        logger.warning("Crisis turn answered via fast path (focus=%s) in %.3f ms", focus, latency * 1000)
+
+        if self.crisis_follow_up and on_follow_up is not None:
+            follow_up = self._inference_pool.submit(self._generate_reply, user_input, history_turns)
+            follow_up.add_done_callback(lambda future: on_follow_up(future.result()))
+        return response, screen, "crisis_intervention"
+
+    def _turn_stages(self, session, user_input):
+        """
+        Prepare a turn as a StageGraph. Emotional analysis (with strategy
+        selection), RAG retrieval and the history segment run concurrently,
+        each tokenizing its own prompt segments, and "prompt" assembles them
+        within the token budget as soon as all three are done, so prefill can
+        start. If the embedding classifier is enabled, the message is embedded
+        first ("embed") and shared by analysis and retrieval.
         """
-        analysis = self.ei_engine.analyze_emotional_state(user_input)
-        strategy = self.strategy_engine.select_strategy(analysis)
+        graph = StageGraph(self._stage_pool)
+        deps = ()
+        if self.ei_engine.classifier is not None:
+            graph.add("embed", lambda: self.rag_engine.embed_query(user_input))
+            deps = ("embed",)
+        graph.add("analysis", lambda embedding=None: self._analyze_turn(session, user_input, embedding), *deps)
+        graph.add("retrieval", lambda embedding=None: self._retrieve(user_input, embedding), *deps)
+        graph.add("history", lambda: self.assembler.history_segments(session.turns(), user_input))
+        graph.add("prompt", lambda analyzed, rag, history: self._join_prompt(analyzed[1], rag, history),
+                  "analysis", "retrieval", "history")
+        return graph
+
+    def _decode_turn(self, graph, user_input, session, prompt, on_text=None, cancelled=None):
+        start = time.perf_counter()
+        response = self._generate_reply(user_input, on_text=on_text, session=session, prompt=prompt,
+                                        cancelled=cancelled)
+        graph.record("generate", start)
+        timings = dict(graph.timings)
+        self.latency_log["stages"].append({
+            "stages": timings,
+            # When prefill could start, against the stages before it run one after another
+            "prompt_ready": timings["prompt"][1],
+            "serial": sum(end - begin for name, (begin, end) in timings.items() if name != "generate"),
+        })
+        return response
 
-        # --- START OF NEW MEMORY LOGIC ---
-        # 1. Build the conversation history from memory
-        history = ""
-        for turn in self.conversation_memory:
-            history += f"User: {turn.get('user', '')}\nTherapist: {turn.get('assistant', '')}\n\n"
+    def stage_summary(self):
+        """
+        Median duration of every turn stage in ms, plus the median time until
+        the prompt was ready ("prompt_ready") and the median time the same
+        stages would take back to back ("serial"). The difference is what
+        running them concurrently takes off the critical path.
+        """
+        turns = list(self.latency_log["stages"])
+        if not turns:
+            return {}
+        durations = {}
+        for turn in turns:
+            for name, (begin, end) in turn["stages"].items():
+                durations.setdefault(name, []).append(end - begin)
+        summary = {name: round(statistics.median(values) * 1000, 2) for name, values in durations.items()}
+        summary["prompt_ready"] = round(statistics.median(turn["prompt_ready"] for turn in turns) * 1000, 2)
+        summary["serial"] = round(statistics.median(turn["serial"] for turn in turns) * 1000, 2)
+        return summary
 
+    def session_cache_summary(self):
+        """
+        How much prefill the session KV cache saved. "reused_fraction" is the
+        share of all prompt tokens taken from the previous turn's cache. Per
+        turn, the cache either covered at least the first remembered turn
+        ("history"), was rebased to about the fixed prefix ("prefix", e.g.
+        after the memory deque dropped its oldest turn), or had nothing to
+        offer ("miss", the first turn of a session). Their rates are the
+        fractions of turns.
+        """
+        turns = list(self.latency_log["session_cache"])
+        if not turns:
+            return {}
+        outcomes = {"history": 0, "prefix": 0, "miss": 0}
+        for turn in turns:
+            if not turn["reused_tokens"]:
+                outcomes["miss"] += 1
+            elif turn["first_turn_end"] and turn["reused_tokens"] >= turn["first_turn_end"]:
+                outcomes["history"] += 1
+            else:
+                outcomes["prefix"] += 1
+        summary = {"turns": len(turns), "reused_fraction": round(
+            sum(t["reused_tokens"] for t in turns) / sum(t["prompt_tokens"] for t in turns), 4)}
+        summary.update({f"{name}_rate": round(count / len(turns), 4) for name, count in outcomes.items()})
+        return summary
+
+    def _retrieve(self, user_input, query_embedding=None):
         # RAG ADDITION: get relevant knowledge from your Chroma DB
-        rag_docs = self.rag_engine.retrieve_relevant_knowledge(user_input, k=self.rag_top_k) # Using the renamed method
-        rag_context = self._format_rag_knowledge(rag_docs)
-
-        # 2. Create the prompt with the history included + RAG context
-        prompt = f"""You are a supportive CBT therapist. Continue the conversation naturally.
-{rag_context}{history}User: {user_input}
-Therapist:"""
-
-        # --- END OF NEW MEMORY LOGIC ---
-        inputs = self.tokenizer(prompt, return_tensors="pt").to(self.model.device)
-
-        with torch.no_grad():
-            outputs = self.model.generate(
-                **inputs,
-                max_new_tokens=250,
-                min_new_tokens=70,
-                do_sample=True,
-                temperature=0.7,
-                top_p=0.95,
-                repetition_penalty=1.2,
-                pad_token_id=self.tokenizer.eos_token_id,
-            )
-
-        raw_response = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-
-        # Extract the part after the LAST "Therapist:"
-        if "Therapist:" in raw_response:
-            generated_text = raw_response.split("Therapist:")[-1].strip()
+        # (one prompt segment per snippet, best first)
+        rag_docs = self.rag_engine.retrieve_relevant_knowledge(
+            user_input, k=self.rag_top_k, query_embedding=query_embedding) # Using the renamed method
+        return self.assembler.rag_segments(self._rag_snippets(rag_docs))
+
+    def _join_prompt(self, strategy, rag, history):
+        # Create the prompt with the history included + RAG context, within the
+        # token budget. Returns (prefix, prompt, inputs, first_turn_end), inputs being
+        # ready for prefill and first_turn_end the token offset after the first remembered turn.
+        # The history comes before the RAG block, so the session cache keeps
+        # the earlier turns when retrieval returns different knowledge.
+        prefix = self._prompt_prefix(strategy)
+        assembled = self.assembler.chat_prompt(prefix, rag, history)
+        if assembled.dropped or assembled.trimmed:
+            logger.debug("Prompt budget: dropped %d and trimmed %d segments, %d tokens",
+                         assembled.dropped, assembled.trimmed, assembled.tokens)
+        self.latency_log["prompt_tokens"].append(assembled.tokens)
+        input_ids = assembled.input_ids[None].to(self.model.device)
+        inputs = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+        return prefix, assembled.text, inputs, assembled.end_of("history")
+
+    def _generate_reply(self, user_input, history_turns=None, query_embedding=None, strategy=None, on_text=None,
+                        session=None, prompt=None, cancelled=None):
+        # Runs on the inference worker (self._inference_pool) in every turn path,
+        # so the model decodes one reply at a time unless a scheduler batches them
+        # prompt: (prefix, prompt, inputs, first_turn_end) already prepared by _turn_stages; otherwise
+        # the prompt is built here from the session's memory (or the given snapshot)
+        # cancelled: optional threading.Event; once set, nothing more is generated
+        # and None is returned
+        if prompt is None:
+            turns = session.turns() if history_turns is None else history_turns
+            prompt = self._join_prompt(strategy, self._retrieve(user_input, query_embedding),
+                                       self.assembler.history_segments(turns, user_input))
+        prefix, prompt, inputs, first_turn_end = prompt
+        # Crisis content is matched case-insensitively; role labels and template
+        # artifacts only as the exact stop sequences, so prose never trips them
+        scanners = []
+        if self.scan_output:
+            scanners.append(self.ei_engine.output_scanner())
+        if self.stop_sequences:
+            scanners.append(StopSequenceScanner(self.stop_sequences))
+        if on_text is not None:
+            # Streaming: sees each chunk after the scanners above have checked it
+            scanners.append(ReplyStream(list(scanners), self.stop_sequences or (), on_text))
+        stopping_criteria = None
+        if scanners:
+            stopping_criteria = StoppingCriteriaList(
+                [SafetyStoppingCriteria(self.tokenizer, scanners, inputs["input_ids"].shape[1])])
+        if cancelled is not None and cancelled.is_set():
+            return None
+
+        if self.scheduler is not None:
+            # Decoded in the shared batch alongside other sessions' replies (the
+            # scheduler keeps its own batched KV cache, so the prefix and session
+            # caches are not used on this path)
+            new_ids = self.scheduler.generate(
+                inputs["input_ids"][0], SamplingParams(**GENERATION_SETTINGS), stopping_criteria,
+                cancel_event=cancelled)
+            sequences = torch.cat([inputs["input_ids"], inputs["input_ids"].new_tensor([new_ids])], dim=1)
+        else:
+            # Start from the previous turn's cache or else the cached prefix; generate()
+            # then only prefills the rest of the prompt. Background follow-ups (which
+            # use a snapshot of the history) leave the session cache alone.
+            past_key_values = None
+            use_session_cache = self.session_cache is not None and history_turns is None
+            if use_session_cache:
+                past_key_values, reused = self.session_cache.take(session.session_id, inputs["input_ids"])
+                prompt_tokens = inputs["input_ids"].shape[1]
+                self.latency_log["session_cache"].append({
+                    "prompt_tokens": prompt_tokens, "reused_tokens": reused, "first_turn_end": first_turn_end})
+                logger.debug("Reusing %d of %d prompt tokens from the previous turn", reused, prompt_tokens)
+            if past_key_values is None and self.prefix_cache is not None:
+                past_key_values = self.prefix_cache.lookup(prefix, inputs["input_ids"])
+
+            if cancelled is not None:
+                stopping_criteria = StoppingCriteriaList(
+                    list(stopping_criteria or []) + [CancellationCriteria(cancelled)])
+            with torch.no_grad():
+                outputs = self.model.generate(
+                    **inputs,
+                    past_key_values=past_key_values,
+                    **GENERATION_SETTINGS,
+                    pad_token_id=self.tokenizer.eos_token_id,
+                    stopping_criteria=stopping_criteria,
+                    return_dict_in_generate=True,
+                )
+            sequences = outputs.sequences
+            if use_session_cache:
+                self.session_cache.store(session.session_id, sequences[0], outputs.past_key_values)
+
+        if cancelled is not None and cancelled.is_set():
+            return None
+
+        safe_text, scanner = stopped_text(scanners)
+        if scanner is not None:
+            # The scanner already holds the reply text; keep what came before the hit
+            hit = scanner.stop_hit
+            log = logger.debug if hit["kind"] == "stop" else logger.warning
+            log("Generation stopped by output scanner (%s: %r) after %d new tokens",
+                hit["kind"], hit["pattern"], sequences.shape[1] - inputs["input_ids"].shape[1])
+            generated_text = safe_text.strip()
         else:
-            generated_text = raw_response.replace(prompt.replace("Therapist:", ""), "").strip()
+            raw_response = self.tokenizer.decode(sequences[0], skip_special_tokens=True)
+
+            # Extract the part after the LAST "Therapist:"
+            if "Therapist:" in raw_response:
+                generated_text = raw_response.split("Therapist:")[-1].strip()
+            else:
+                generated_text = raw_response.replace(prompt.replace("Therapist:", ""), "").strip()
 
         # Polishing the response
-        polished_response = self.post_process_response(generated_text)
+        return self.post_process_response(generated_text)
+
+
+async def _acquire(lock):
+    # Wait for a threading.Lock without blocking the event loop. If the wait is
+    # cancelled, the lock is released again as soon as the waiting thread gets it.
+    future = asyncio.get_running_loop().run_in_executor(None, lock.acquire)
+    try:
+        await asyncio.shield(future)
+    except asyncio.CancelledError:
+        future.add_done_callback(lambda _: lock.release())
+        raise
+
+
+def _call_after(callback, futures):
+    # Call callback() once every future (concurrent.futures) has finished
+    pending = [future for future in futures if not future.done()]
+    if not pending:
+        callback()
+        return
+    remaining = [len(pending)]
+    counter = threading.Lock()
 
-        # Add the current turn to memory
-        self.conversation_memory.append({'user': user_input, 'assistant': polished_response})
+    def finished(_):
+        with counter:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            callback()
 
-        return polished_response, analysis, strategy
+    for future in pending:
+        future.add_done_callback(finished)
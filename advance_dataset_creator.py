@@ -1,27 +1,98 @@
+import random
+
+from cbt_strategy_engine import CBTResponseStrategyEngine
+from emotional_intelligence_engine import EmotionalIntelligenceEngine
+
 class AdvancedDatasetCreator:
     def __init__(self):
-        self.eiengine = EmotionalIntelligenceEngine()
-        self.strategyengine = CBTResponseStrategyEngine()
-        self.masterexamples = [
+        self.ei_engine = EmotionalIntelligenceEngine()
+        self.strategy_engine = CBTResponseStrategyEngine()
+        # (strategy, primary emotions, first three distortions) -> rendered header
+        self._system_headers = {}
+        self.master_examples = [
             # Placeholders for hand-crafted master CBT examples
         ]
 
-    def createultimateprompt(self, example, analysis=None):
+    def create_ultimate_prompt(self, example, analysis=None, primary_emotions=None, strategy=None):
         if analysis is None:
-            analysis = self.eiengine.analyzeemotionalstate(example["input"])
-        strategy = self.strategyengine.selectstrategy(analysis)
-        approachinfo = self.strategyengine.therapyapproaches[strategy]
-        systemprompt = (
-            "You are a master CBT therapist with 25 years of experience, specializing in "
-            f"{strategy.replace('_', ' ')}. "
-            "Your therapeutic approach is guided by the following clinical assessment of the user's message: "
-            f"Primary Emotions: {', '.join(analysis['primaryemotions']) if analysis['primaryemotions'] else 'mixed presentation'}. "
-            f"Detected Cognitive Distortions: {', '.join(analysis['cognitivedistortions'][:3]) if analysis['cognitivedistortions'] else 'none identified'}. "
-            f"Therapeutic Focus: {approachinfo['priority']}. "
-            f"Therapeutic Tone: {approachinfo['tone']}. "
-            "Your goal is to provide a response that is validating, insightful, and offers a clear, collaborative next step. "
-            "Be empathetic and professional."
-        )
-        return f"<SYS>\n{systemprompt}\n</SYS>\nINST {example['input']}\n{example['output']}"
-
-    # Methods for dataset enhancement and augmentation not shown for brevity.
+            analysis = self.ei_engine.analyze_emotional_state(example["input"])
+        if primary_emotions is None:
+            primary_emotions = analysis.primary_emotions
+        if strategy is None:
+            strategy = self.strategy_engine.select_strategy(analysis)
+        header = self.system_header(strategy, primary_emotions, analysis.cognitive_distortions[:3])
+        return "".join((header, example["input"], "\n", example["output"]))
+
+    def system_header(self, strategy, primary_emotions, cognitive_distortions):
+        """
+        Everything in a training prompt before the user's message: the <SYS>
+        block and the INST tag. The header only depends on the strategy, the
+        primary emotions and the first three distortions, so each distinct
+        combination is rendered once and reused (see system_header_count).
+        """
+        key = (strategy, tuple(primary_emotions), tuple(cognitive_distortions))
+        header = self._system_headers.get(key)
+        if header is None:
+            approachinfo = self.strategy_engine.therapy_approaches[strategy]
+            systemprompt = (
+                "You are a master CBT therapist with 25 years of experience, specializing in "
+                f"{strategy.replace('_', ' ')}. "
+                "Your therapeutic approach is guided by the following clinical assessment of the user's message: "
+                f"Primary Emotions: {', '.join(primary_emotions) if primary_emotions else 'mixed presentation'}. "
+                f"Detected Cognitive Distortions: {', '.join(cognitive_distortions) if cognitive_distortions else 'none identified'}. "
+                f"Therapeutic Focus: {approachinfo['priority']}. "
+                f"Therapeutic Tone: {approachinfo['tone']}. "
+                "Your goal is to provide a response that is validating, insightful, and offers a clear, collaborative next step. "
+                "Be empathetic and professional."
+            )
+            header = self._system_headers.setdefault(key, f"<SYS>\n{systemprompt}\n</SYS>\nINST ")
+        return header
+
+    @property
+    def system_header_count(self):
+        """Number of distinct system-prompt headers rendered so far."""
+        return len(self._system_headers)
+
+    def augment_dataset(self, raw_data, workers=None, sentiment_backend="vader"):
+        print("🧠 Creating Ultimate CBT Dataset with Advanced Psychology...")
+        enhanced_data = [{"text": self.create_ultimate_prompt(ex)} for ex in self.master_examples]
+
+        # Analyze every input in one batch instead of one call per example
+        batch = self.ei_engine.analyze_emotional_states(
+            (ex["input"] for ex in raw_data), workers=workers, sentiment_backend=sentiment_backend)
+        analyses = self.ei_engine.expand_emotional_states(batch)
+        strategies = self.strategy_engine.select_strategies(batch)
+
+        for idx, (example, analysis, strategy) in enumerate(zip(raw_data, analyses, strategies)):
+            if idx % 50 == 0:
+                print(f"Processing example {idx+1}/{len(raw_data)}")
+            enhanced_example = {
+                "input": example["input"].strip(),
+                "output": self.enhance_output_quality(example["output"])
+            }
+            enhanced_data.append({"text": self.create_ultimate_prompt(enhanced_example, analysis, strategy=strategy)})
+
+            # Create variation with different strategy (data augmentation)
+            primary_emotions = analysis.primary_emotions
+            if len(primary_emotions) > 1:
+                enhanced_data.append({"text": self.create_ultimate_prompt(
+                    enhanced_example, analysis, primary_emotions=primary_emotions[::-1], strategy=strategy)})
+
+        print(f"✅ Enhanced dataset created: {len(enhanced_data)} examples")
+        print(f"🧩 {self.system_header_count} distinct system prompts")
+        return enhanced_data
+
+    def enhance_output_quality(self, original_output):
+        """Enhance the quality of therapist responses"""
+        output = original_output.strip()
+        if not output.endswith((".", "!", "?")):
+            output += "."
+        collaborative_endings = [
+            "What are your thoughts on this perspective?",
+            "How does this resonate with you?",
+            "What would you like to explore further?",
+            "What feels most helpful to focus on right now?"
+        ]
+        if len(output.split()) < 30 or not any(word in output.lower() for word in ["you", "your", "what", "how"]):
+            output += f" {random.choice(collaborative_endings)}"
+        return output
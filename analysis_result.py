@@ -0,0 +1,150 @@
+import json
+import threading
+
+INTENSITY_LEVELS = ("none", "mild", "moderate", "severe")
+SENTIMENT_KEYS = ("neg", "neu", "pos", "compound")
+
+_labels_lock = threading.Lock()
+_interned_labels = {}
+
+
+class AnalysisLabels:
+    """
+    The emotion and distortion names an AnalysisResult's bit flags refer to.
+    Bit i of emotion_bits is emotions[i]; intensity codes take two bits per
+    emotion, at bit 2*i. One instance is shared per label set (see labels_for).
+    """
+    __slots__ = ("emotions", "distortions", "emotion_index", "distortion_index")
+
+    def __init__(self, emotions, distortions):
+        self.emotions = tuple(emotions)
+        self.distortions = tuple(distortions)
+        self.emotion_index = {e: i for i, e in enumerate(self.emotions)}
+        self.distortion_index = {d: i for i, d in enumerate(self.distortions)}
+
+    def emotion_mask(self, emotions):
+        """Bit mask with the bits of the given emotion names set (unknown names are ignored)."""
+        index = self.emotion_index
+        return sum(1 << index[e] for e in emotions if e in index)
+
+    def distortion_mask(self, distortions):
+        index = self.distortion_index
+        return sum(1 << index[d] for d in distortions if d in index)
+
+    def __reduce__(self):
+        return labels_for, (self.emotions, self.distortions)
+
+
+def labels_for(emotions, distortions):
+    """Return the shared AnalysisLabels for these emotion and distortion names."""
+    key = (tuple(emotions), tuple(distortions))
+    labels = _interned_labels.get(key)
+    if labels is None:
+        with _labels_lock:
+            labels = _interned_labels.setdefault(key, AnalysisLabels(*key))
+    return labels
+
+
+class AnalysisResult:
+    """
+    Immutable result of analyzing one message, produced by every
+    EmotionalIntelligenceEngine method and read by the strategy engine, the
+    conversation tracker and the generation engine.
+
+    Detected emotions and distortions are stored as integer bit sets over the
+    names in `labels`, emotion intensities as two-bit codes into
+    INTENSITY_LEVELS and sentiment as a (neg, neu, pos, compound) tuple, or
+    None when VADER was not run (screen_message). The list and dict views
+    below are computed on access. to_dict() gives the plain form used for logs
+    and JSON, with the same keys everywhere:
+    primary_emotions, emotion_intensities, sentiment, cognitive_distortions,
+    crisis_level.
+    """
+    __slots__ = ("labels", "emotion_bits", "intensity_bits", "distortion_bits", "crisis", "sentiment")
+
+    def __init__(self, labels, emotion_bits=0, intensity_bits=0, distortion_bits=0, crisis=False, sentiment=None):
+        set_field = object.__setattr__
+        set_field(self, "labels", labels)
+        set_field(self, "emotion_bits", emotion_bits)
+        set_field(self, "intensity_bits", intensity_bits)
+        set_field(self, "distortion_bits", distortion_bits)
+        set_field(self, "crisis", crisis)
+        set_field(self, "sentiment", sentiment)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("AnalysisResult is immutable; use replace()")
+
+    __delattr__ = __setattr__
+
+    def replace(self, **changes):
+        """Return a copy with some fields replaced, e.g. result.replace(crisis=False)."""
+        fields = {name: getattr(self, name) for name in self.__slots__}
+        fields.update(changes)
+        return AnalysisResult(**fields)
+
+    @property
+    def detected_emotions(self):
+        bits = self.emotion_bits
+        return [e for i, e in enumerate(self.labels.emotions) if bits >> i & 1]
+
+    @property
+    def primary_emotions(self):
+        return self.detected_emotions[:2]
+
+    @property
+    def emotion_intensities(self):
+        bits, codes = self.emotion_bits, self.intensity_bits
+        return {e: INTENSITY_LEVELS[codes >> 2 * i & 3] for i, e in enumerate(self.labels.emotions) if bits >> i & 1}
+
+    @property
+    def cognitive_distortions(self):
+        bits = self.distortion_bits
+        return [d for i, d in enumerate(self.labels.distortions) if bits >> i & 1]
+
+    @property
+    def crisis_level(self):
+        return "high" if self.crisis else "low"
+
+    @property
+    def compound(self):
+        return None if self.sentiment is None else self.sentiment[3]
+
+    def has_emotion(self, emotion):
+        index = self.labels.emotion_index.get(emotion)
+        return index is not None and bool(self.emotion_bits >> index & 1)
+
+    def has_distortion(self, distortion):
+        index = self.labels.distortion_index.get(distortion)
+        return index is not None and bool(self.distortion_bits >> index & 1)
+
+    def to_dict(self):
+        return {
+            "primary_emotions": self.primary_emotions,
+            "emotion_intensities": self.emotion_intensities,
+            "sentiment": None if self.sentiment is None else dict(zip(SENTIMENT_KEYS, self.sentiment)),
+            "cognitive_distortions": self.cognitive_distortions,
+            "crisis_level": self.crisis_level,
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+    def _key(self):
+        return (self.labels.emotions, self.labels.distortions, self.emotion_bits, self.intensity_bits,
+                self.distortion_bits, self.crisis, self.sentiment)
+
+    def __eq__(self, other):
+        if not isinstance(other, AnalysisResult):
+            return NotImplemented
+        return self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __reduce__(self):
+        return AnalysisResult, (self.labels, self.emotion_bits, self.intensity_bits,
+                                self.distortion_bits, self.crisis, self.sentiment)
+
+    def __repr__(self):
+        return (f"AnalysisResult(emotions={self.emotion_intensities}, distortions={self.cognitive_distortions}, "
+                f"crisis_level={self.crisis_level!r}, sentiment={self.sentiment})")
@@ -0,0 +1,282 @@
+"""
+Benchmarks for the analysis and strategy engines.
+
+Measures messages/sec, p50/p99 latency and peak allocated bytes per message for
+single-message and batch analysis, screen_message and single/batch strategy
+selection, over the messages in cbt_500.jsonl plus a synthetic corpus built
+from the pattern vocabularies. Results can be saved as a JSON baseline and
+later runs compared against it:
+
+    python benchmark_engines.py --save bench_baseline.json
+    python benchmark_engines.py --compare bench_baseline.json   # exits 1 on a regression
+
+Every figure is the median over --repeat passes, and a slowdown only counts
+as a regression when it is both relative (--tolerance) and absolute
+(--floor-us per message), so a fresh baseline compares clean on the machine
+that recorded it.
+"""
+import argparse
+import functools
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+
+from cbt_strategy_engine import CBTResponseStrategyEngine
+from emotional_intelligence_engine import EmotionalIntelligenceEngine, get_vectorized_scorer
+
+CORPUS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cbt_500.jsonl")
+
+_FILLER = [
+    "I don't really know how to explain it", "lately things at work have been a lot",
+    "my sister keeps asking how I am", "I tried going for a walk yesterday",
+    "it's been like this for a few weeks", "I keep thinking about what happened",
+    "sometimes I just sit there", "I haven't been sleeping well",
+    "everyone says it will get better", "I'm not sure this is helping",
+]
+
+
+def load_corpus(path=CORPUS_FILE):
+    """Every user input and therapist output in a cbt_500-style JSONL file."""
+    with open(path, encoding="utf-8") as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+    return [row["input"] for row in rows] + [row["output"] for row in rows]
+
+
+def synthetic_corpus(n, engine=None, seed=0, crisis_rate=0.01):
+    """
+    Generate n messages mixing filler sentences with keywords, intensity
+    markers and distortion phrases drawn from the engine's pattern tables, so
+    the corpus keeps exercising new vocabulary as it is added.
+    """
+    engine = engine or EmotionalIntelligenceEngine(cache_size=0)
+    rng = random.Random(seed)
+    phrases = [kw for p in engine.emotion_patterns.values() for kw in p["keywords"] + p.get("intensity_markers", [])]
+    phrases += [pattern for patterns in engine.cognitive_distortions.values() for pattern in patterns]
+    messages = []
+    for _ in range(n):
+        parts = [rng.choice(_FILLER) for _ in range(rng.randint(1, 4))]
+        for _ in range(rng.randint(0, 3)):
+            parts.insert(rng.randrange(len(parts) + 1), f"I feel {rng.choice(phrases)}")
+        if rng.random() < crisis_rate:
+            parts.append(f"sometimes I {rng.choice(engine.crisis_keywords)}")
+        text = ". ".join(parts) + rng.choice([".", "!", "?", "...", "!!"])
+        if rng.random() < 0.1:
+            text = text.upper()
+        messages.append(text)
+    return messages
+
+
+def _allocations(fn, items, sizes, sample=200):
+    # Peak traced memory of each call over a sample (transient allocations included,
+    # tracemalloc has no running total), averaged per message
+    tracemalloc.start()
+    total = 0
+    try:
+        for item in items[:sample]:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            fn(item)
+            total += tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+    messages = sum(sizes[:sample])
+    return total / messages if messages else 0.0
+
+
+def bench_calls(fn, items, sizes=None, warmup=20, repeat=5):
+    """
+    Time fn(item) for every item. sizes gives the number of messages in each
+    item (batch mode); latencies are reported per message either way. The
+    pass over items is repeated and every figure is the median over the
+    passes, so a single slow (or lucky) pass does not move the baseline.
+    """
+    sizes = sizes or [1] * len(items)
+    messages = sum(sizes)
+    for item in items[:warmup]:
+        fn(item)
+    clock = time.perf_counter_ns
+    rates, p50s, p99s = [], [], []
+    for _ in range(repeat):
+        latencies, total_ns = [], 0
+        for item, size in zip(items, sizes):
+            start = clock()
+            fn(item)
+            elapsed = clock() - start
+            total_ns += elapsed
+            latencies.append(elapsed / size)
+        latencies_us = np.asarray(latencies, dtype=np.float64) / 1000.0
+        if total_ns:
+            rates.append(messages / (total_ns / 1e9))
+        p50s.append(float(np.percentile(latencies_us, 50)))
+        p99s.append(float(np.percentile(latencies_us, 99)))
+    return {
+        "messages": messages,
+        "messages_per_sec": round(statistics.median(rates), 1) if rates else None,
+        "p50_us": round(statistics.median(p50s), 2),
+        "p99_us": round(statistics.median(p99s), 2),
+        "peak_alloc_bytes_per_message": round(_allocations(fn, items, sizes), 1),
+    }
+
+
+def run_benchmarks(messages, batch_size=256, only=None, repeat=5):
+    """Run every benchmark over `messages` and return {name: summary}."""
+    results = {}
+    bench = functools.partial(bench_calls, repeat=repeat)
+
+    def want(name):
+        return only is None or name in only
+
+    uncached = EmotionalIntelligenceEngine(cache_size=0)
+    if want("screen_message"):
+        results["screen_message"] = bench(uncached.screen_message, messages)
+    if want("analyze_single"):
+        results["analyze_single"] = bench(uncached.analyze_emotional_state, messages)
+    if want("analyze_single_cached"):
+        cached = EmotionalIntelligenceEngine(cache_size=len(messages))
+        for text in messages:
+            cached.analyze_emotional_state(text)
+        results["analyze_single_cached"] = bench(cached.analyze_emotional_state, messages)
+    if want("select_strategy"):
+        strategy_engine = CBTResponseStrategyEngine()
+        analyses = [uncached.screen_message(text) for text in messages]
+        results["select_strategy"] = bench(strategy_engine.select_strategy, analyses)
+
+    # Batch mode: latencies are per batch divided by its size
+    batches = [messages[i:i + batch_size] for i in range(0, len(messages), batch_size)]
+    sizes = [len(batch) for batch in batches]
+    for backend in ("vader", "vectorized"):
+        name = f"analyze_batch_{backend}"
+        if want(name):
+            results[name] = bench(
+                lambda batch: uncached.analyze_emotional_states(batch, sentiment_backend=backend),
+                batches, sizes, warmup=1)
+    if want("select_strategies_batch"):
+        strategy_engine = CBTResponseStrategyEngine()
+        analyzed = [uncached.analyze_emotional_states(batch) for batch in batches]
+        results["select_strategies_batch"] = bench(strategy_engine.select_strategies, analyzed, sizes, warmup=1)
+    return results
+
+
+def run(corpus_file=CORPUS_FILE, synthetic=5000, seed=0, batch_size=256, only=None, repeat=5):
+    engine = EmotionalIntelligenceEngine(cache_size=0)
+    corpora = {"cbt_500": load_corpus(corpus_file)}
+    if synthetic:
+        corpora["synthetic"] = synthetic_corpus(synthetic, engine, seed)
+    report = {
+        "meta": {
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pattern_version": engine.pattern_version,
+            "pattern_count": len(engine.matcher.patterns),
+            "batch_size": batch_size,
+            "repeat": repeat,
+            "corpora": {name: len(texts) for name, texts in corpora.items()},
+        },
+        "results": {name: run_benchmarks(texts, batch_size, only, repeat) for name, texts in corpora.items()},
+    }
+    # Not a timing: how closely the vectorized sentiment backend tracks VADER on this corpus
+    report["meta"]["vectorized_sentiment_parity"] = get_vectorized_scorer().compare_with_vader(corpora["cbt_500"])
+    return report
+
+
+def _us_per_message(metric, value):
+    # Throughput as time per message, so every timing can be held to the same absolute floor
+    return 1e6 / value if metric == "messages_per_sec" else value
+
+
+def compare(report, baseline, tolerance=0.25, floor_us=1.0):
+    """
+    Compare a report with a saved baseline. Returns (regressions, warnings),
+    both lists of lines. A regression is throughput down, or p50 /
+    allocations up, by more than `tolerance`; for the timings the slowdown
+    must also exceed floor_us per message, since sub-microsecond benchmarks
+    are dominated by timer resolution (0.3 -> 0.6 us is +100% of nothing).
+    p99 is too noisy to gate on and only ever produces warnings. Benchmarks
+    missing from either side are skipped.
+    """
+    checks = (("messages_per_sec", -1, True), ("p50_us", 1, True),
+              ("peak_alloc_bytes_per_message", 1, False), ("p99_us", 1, True))
+    regressions, warnings = [], []
+    for corpus, benchmarks in report["results"].items():
+        for name, current in benchmarks.items():
+            previous = baseline.get("results", {}).get(corpus, {}).get(name)
+            if not previous:
+                continue
+            for metric, direction, timing in checks:
+                old, new = previous.get(metric), current.get(metric)
+                if not old or not new:
+                    continue
+                change = (new - old) / old * direction
+                if change <= tolerance:
+                    continue
+                if timing and _us_per_message(metric, new) - _us_per_message(metric, old) <= floor_us:
+                    continue
+                line = f"{corpus}/{name} {metric}: {old} -> {new} ({change:+.0%} worse)"
+                (warnings if metric == "p99_us" else regressions).append(line)
+    return regressions, warnings
+
+
+def print_report(report):
+    meta = report["meta"]
+    print(f"📊 Engine benchmarks (patterns v{meta['pattern_version']}, {meta['pattern_count']} patterns)")
+    for corpus, benchmarks in report["results"].items():
+        print(f"\n{corpus} ({meta['corpora'][corpus]} messages)")
+        print(f"  {'benchmark':<26}{'msg/s':>12}{'p50 us':>10}{'p99 us':>10}{'peak B/msg':>13}")
+        for name, r in benchmarks.items():
+            print(f"  {name:<26}{r['messages_per_sec']:>12,.0f}{r['p50_us']:>10.1f}{r['p99_us']:>10.1f}"
+                  f"{r['peak_alloc_bytes_per_message']:>13,.0f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the analysis and strategy engines.")
+    parser.add_argument("--corpus", default=CORPUS_FILE)
+    parser.add_argument("--synthetic", type=int, default=5000, help="synthetic messages to generate (0 to skip)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--only", nargs="+", help="run only these benchmarks")
+    parser.add_argument("--repeat", type=int, default=5, help="passes per benchmark; the median is reported")
+    parser.add_argument("--save", help="write the report to this JSON baseline")
+    parser.add_argument("--compare", help="compare against this JSON baseline and fail on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed relative slowdown; compare baselines from the same machine")
+    parser.add_argument("--floor-us", type=float, default=1.0,
+                        help="timings must also slow down by more than this many us per message to fail")
+    args = parser.parse_args(argv)
+
+    report = run(args.corpus, args.synthetic, args.seed, args.batch_size, args.only, args.repeat)
+    print_report(report)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\n✅ Baseline saved to {args.save}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline["meta"].get("pattern_version") != report["meta"]["pattern_version"]:
+            print(f"\nℹ️ Pattern version changed: {baseline['meta'].get('pattern_version')} -> "
+                  f"{report['meta']['pattern_version']}")
+        regressions, warnings = compare(report, baseline, args.tolerance, args.floor_us)
+        if warnings:
+            print("\n⚠️ Slower tail latencies (not failing):")
+            for line in warnings:
+                print(f"  - {line}")
+        if regressions:
+            print("\n❌ Regressions against baseline:")
+            for line in regressions:
+                print(f"  - {line}")
+            return 1
+        print("\n✅ No regressions against baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
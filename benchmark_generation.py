@@ -0,0 +1,193 @@
+"""
+Throughput and latency of the batching schedulers (continuous batching and
+micro-batching) compared with one model.generate call per request.
+
+Runs on the CPU by default with a small randomly initialized Phi model, so
+batching gains can be measured without a GPU or a model download:
+
+    python benchmark_generation.py                                   # tiny Phi, CPU
+    python benchmark_generation.py --batch-sizes 1 4 16 --requests 64
+    python benchmark_generation.py --arrival-ms 50 --window-ms 20    # staggered arrivals
+    python benchmark_generation.py --model microsoft/phi-2 --device cuda
+
+Decoding is greedy with a fixed number of new tokens per request (EOS is
+suppressed), so every mode generates the same number of tokens; --check
+verifies that the schedulers' outputs equal model.generate's. Latencies
+are measured from each request's arrival, so they include queue time.
+"""
+import argparse
+import json
+import random
+import sys
+import time
+
+import numpy as np
+import torch
+from transformers import AutoModelForCausalLM, PhiConfig, PhiForCausalLM
+
+from generation_scheduler import ContinuousBatchingScheduler, MicroBatchingScheduler, SamplingParams
+
+
+def tiny_phi(layers=4, hidden=256, heads=8, vocab=2048, seed=0):
+    """A small randomly initialized Phi model, same architecture as phi-2."""
+    torch.manual_seed(seed)
+    config = PhiConfig(vocab_size=vocab, hidden_size=hidden, intermediate_size=4 * hidden,
+                       num_hidden_layers=layers, num_attention_heads=heads, max_position_embeddings=2048,
+                       pad_token_id=0, bos_token_id=1, eos_token_id=2)
+    return PhiForCausalLM(config).eval()
+
+
+def make_requests(n, vocab, prompt_lengths=(16, 128), new_tokens=(16, 96), seed=0):
+    """n (prompt token ids, new token count) pairs of random lengths."""
+    rng = random.Random(seed)
+    return [([rng.randrange(3, vocab) for _ in range(rng.randint(*prompt_lengths))], rng.randint(*new_tokens))
+            for _ in range(n)]
+
+
+def arrival_offsets(n, arrival_ms, seed=0):
+    """Poisson arrival times (seconds from the start) with mean gap arrival_ms; all 0 if arrival_ms is 0."""
+    rng = random.Random(seed)
+    offsets, t = [], 0.0
+    for _ in range(n):
+        offsets.append(t)
+        if arrival_ms:
+            t += rng.expovariate(1000.0 / arrival_ms)
+    return offsets
+
+
+def _wait_until(moment):
+    delay = moment - time.perf_counter()
+    if delay > 0:
+        time.sleep(delay)
+
+
+def _summary(tokens, elapsed, latencies, first_tokens=None):
+    summary = {
+        "tokens": tokens,
+        "tokens_per_sec": round(tokens / elapsed, 1),
+        "p50_latency_ms": round(float(np.percentile(latencies, 50)) * 1000, 1),
+        "p99_latency_ms": round(float(np.percentile(latencies, 99)) * 1000, 1),
+    }
+    if first_tokens is not None:
+        summary["p50_first_token_ms"] = round(float(np.percentile(first_tokens, 50)) * 1000, 1)
+    return summary
+
+
+def bench_serial(model, requests, eos_token_id, arrivals):
+    """Requests served one after another with model.generate (batch size 1) as they arrive."""
+    device = model.device
+    outputs, latencies = [], []
+    start = time.perf_counter()
+    with torch.no_grad():
+        for (prompt, new_tokens), offset in zip(requests, arrivals):
+            _wait_until(start + offset)
+            input_ids = torch.tensor([prompt], device=device)
+            sequence = model.generate(input_ids, attention_mask=torch.ones_like(input_ids),
+                                      max_new_tokens=new_tokens, min_new_tokens=new_tokens, do_sample=False,
+                                      pad_token_id=eos_token_id, eos_token_id=eos_token_id)
+            outputs.append(sequence[0, len(prompt):].tolist())
+            latencies.append(time.perf_counter() - start - offset)
+    elapsed = time.perf_counter() - start
+    return _summary(sum(len(o) for o in outputs), elapsed, latencies), outputs
+
+
+def bench_scheduler(scheduler, requests, arrivals):
+    """Requests submitted at their arrival times to a scheduler running in its background thread."""
+    scheduler.start()
+    start = time.perf_counter()
+    submitted = []
+    for (prompt, n), offset in zip(requests, arrivals):
+        _wait_until(start + offset)
+        submitted.append(scheduler.submit(prompt, SamplingParams(max_new_tokens=n, min_new_tokens=n,
+                                                                 do_sample=False)))
+    outputs = [request.result() for request in submitted]
+    elapsed = time.perf_counter() - start
+    scheduler.stop()
+    summary = _summary(sum(len(o) for o in outputs), elapsed,
+                       [request.finished - request.submitted for request in submitted],
+                       [request.first_token_time - request.submitted for request in submitted])
+    summary["mean_batch_rows"] = round(scheduler.mean_batch_rows, 2)
+    if isinstance(scheduler, MicroBatchingScheduler):
+        summary["by_batch_size"] = scheduler.metrics()
+    return summary, outputs
+
+
+def run(model, requests, eos_token_id, batch_sizes, window_ms=10.0, arrival_ms=0.0, check=False, seed=0):
+    arrivals = arrival_offsets(len(requests), arrival_ms, seed)
+    results = {}
+    results["serial_generate"], reference = bench_serial(model, requests, eos_token_id, arrivals)
+    for batch_size in batch_sizes:
+        schedulers = {
+            f"continuous_batch_{batch_size}": ContinuousBatchingScheduler(model, eos_token_id, batch_size),
+            f"micro_batch_{batch_size}": MicroBatchingScheduler(model, eos_token_id, max_batch_size=batch_size,
+                                                                window_ms=window_ms),
+        }
+        for name, scheduler in schedulers.items():
+            summary, outputs = bench_scheduler(scheduler, requests, arrivals)
+            if check:
+                summary["matches_generate"] = outputs == reference
+            results[name] = summary
+    return results
+
+
+def print_report(results, meta):
+    print(f"📊 Generation benchmarks ({meta['model']}, {meta['device']}, {meta['requests']} requests, "
+          f"arrivals every {meta['arrival_ms']} ms, window {meta['window_ms']} ms)")
+    print(f"  {'mode':<22}{'tok/s':>10}{'speedup':>9}{'p50 ms':>10}{'p99 ms':>10}{'rows':>7}")
+    baseline = results["serial_generate"]["tokens_per_sec"]
+    for name, r in results.items():
+        rows = r.get("mean_batch_rows", 1)
+        check = {True: " ✅", False: " ❌"}.get(r.get("matches_generate"), "")
+        print(f"  {name:<22}{r['tokens_per_sec']:>10,.0f}{r['tokens_per_sec'] / baseline:>8.2f}x"
+              f"{r['p50_latency_ms']:>10,.0f}{r['p99_latency_ms']:>10,.0f}{rows:>7}{check}")
+    for name, r in results.items():
+        if r.get("by_batch_size"):
+            print(f"\n⏱️ {name}: queue time by batch size")
+            for size, m in r["by_batch_size"].items():
+                print(f"  size {size:<4}{m['batches']:>5} batches   p50 queue {m['p50_queue_ms']:>8,.1f} ms   "
+                      f"p99 queue {m['p99_queue_ms']:>8,.1f} ms   {m['tokens_per_sec']:>8,.0f} tok/s")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the batching schedulers against serial generate().")
+    parser.add_argument("--model", help="Hugging Face model name or path (default: a tiny random Phi model)")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--window-ms", type=float, default=10.0, help="micro-batching collection window")
+    parser.add_argument("--arrival-ms", type=float, default=0.0,
+                        help="mean gap between Poisson request arrivals (0: all requests at once)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--threads", type=int, help="torch CPU threads")
+    parser.add_argument("--check", action="store_true", help="verify outputs equal model.generate's")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    if args.model:
+        model = AutoModelForCausalLM.from_pretrained(args.model).eval()
+    else:
+        model = tiny_phi(seed=args.seed)
+    model.to(args.device)
+    eos_token_id = model.config.eos_token_id
+    requests = make_requests(args.requests, model.config.vocab_size, seed=args.seed)
+
+    meta = {"model": args.model or "tiny-phi (random)", "device": args.device, "requests": args.requests,
+            "window_ms": args.window_ms, "arrival_ms": args.arrival_ms,
+            "torch": torch.__version__, "threads": torch.get_num_threads()}
+    results = run(model, requests, eos_token_id, args.batch_sizes, args.window_ms, args.arrival_ms, args.check,
+                  args.seed)
+    print_report(results, meta)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"meta": meta, "results": results}, f, indent=2)
+        print(f"\n✅ Results saved to {args.save}")
+    if args.check and not all(r.get("matches_generate", True) for r in results.values()):
+        print("\n❌ Scheduler outputs differ from model.generate")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,3 +1,62 @@
+import numpy as np
+
+# Triage rules. Crisis rules always come first and distortion rules after
+# every emotion rule (see select_strategy); emotion rules are tried in the
+# order listed, and the first that applies picks the strategy.
+#   "crisis": the message hit a crisis keyword
+#   "emotion": the label is one of the message's primary emotions (or, failing
+#              that, one of the conversation's dominant emotions)
+#   "distortion": any cognitive distortion was detected
+STRATEGY_RULES = (
+    ("crisis", None, "crisis_intervention"),
+    ("emotion", "trauma", "trauma_informed"),
+    ("emotion", "anxiety", "anxiety_focused"),
+    ("emotion", "depression", "depression_focused"),
+    ("emotion", "relationships", "relationship_focused"),
+    ("distortion", None, "cognitive_restructuring"),
+)
+DEFAULT_STRATEGY = "cognitive_restructuring"
+# Emotion tables larger than this are matched rule by rule instead of via a full lookup table
+_MAX_TABLE_EMOTIONS = 12
+
+
+def _primary_mask(emotion_bits):
+    # The two lowest set bits: the first two detected emotions in table order
+    first = emotion_bits & -emotion_bits
+    rest = emotion_bits ^ first
+    return first | (rest & -rest)
+
+
+class _CompiledRules:
+    """
+    STRATEGY_RULES resolved against one emotion label order. emotion_rules holds
+    (bit mask, strategy) pairs; when the label set is small, by_emotions maps
+    every possible set of emotions straight to the first matching strategy
+    (or None), and by_bits does the same for a message's full emotion_bits.
+    """
+
+    def __init__(self, emotions):
+        index = {emotion: i for i, emotion in enumerate(emotions)}
+        self.emotion_rules = [(1 << index[label], strategy) for kind, label, strategy in STRATEGY_RULES
+                              if kind == "emotion" and label in index]
+        self.by_emotions = self.by_bits = None
+        if len(emotions) <= _MAX_TABLE_EMOTIONS:
+            self.by_emotions = [self._match(mask) for mask in range(1 << len(emotions))]
+            self.by_bits = [self.by_emotions[_primary_mask(bits)] for bits in range(1 << len(emotions))]
+
+    def _match(self, mask):
+        for rule_mask, strategy in self.emotion_rules:
+            if mask & rule_mask:
+                return strategy
+        return None
+
+    def for_emotions(self, mask):
+        return self.by_emotions[mask] if self.by_emotions is not None else self._match(mask)
+
+    def for_bits(self, emotion_bits):
+        return self.by_bits[emotion_bits] if self.by_bits is not None else self._match(_primary_mask(emotion_bits))
+
+
 class CBTResponseStrategyEngine:
     """
     This class is designed to act as the brain of our application. 
@@ -44,8 +103,11 @@ class CBTResponseStrategyEngine:
                 "tone": "collaborative, curious, logical"
             }
         }
+        self.crisis_strategy = next(s for kind, _, s in STRATEGY_RULES if kind == "crisis")
+        self.distortion_strategy = next((s for kind, _, s in STRATEGY_RULES if kind == "distortion"), None)
+        self._rules_cache = {}
 
-    def select_strategy(self, emotional_analysis):
+    def select_strategy(self, emotional_analysis, conversation_state=None):
         """
         Core decision-making method that selects the most appropriate 
         therapeutic strategy based on emotional analysis.
@@ -54,19 +116,25 @@ class CBTResponseStrategyEngine:
         ============================================
         
         1. SAFETY FIRST - Crisis Detection
-           - If crisislevel == "high", immediately return "crisis_intervention"
+           - If crisis_level == "high", immediately return "crisis_intervention"
            - This ensures that safety is the absolute top priority,
              overriding all other emotional indicators.
         
         2. EMOTION-BASED SELECTION
            - After ensuring safety, examine primary emotions detected by
              the EmotionalIntelligenceEngine.
-           - Each primary emotion maps to a specific strategy:
+           - Each primary emotion maps to a specific strategy, in this priority:
              * trauma → trauma_informed
              * anxiety → anxiety_focused
              * depression → depression_focused
              * relationships → relationship_focused
         
+        2b. CONVERSATION CONTEXT
+           - If the current message shows no mapped emotion and a
+             conversation_state snapshot is given, the conversation's
+             dominant emotions are used with the same mapping, so a short
+             "I don't know what to do" stays in the context of the session.
+        
         3. COGNITIVE DISTORTION FALLBACK
            - If no primary emotion is detected but cognitive distortions are present,
              use cognitive_restructuring (the core CBT technique).
@@ -75,38 +143,80 @@ class CBTResponseStrategyEngine:
            - If none of the above conditions apply,
              return cognitive_restructuring as a safe, generally helpful approach.
         
+        The rules live in the STRATEGY_RULES table at the top of this module
+        and are compiled into a lookup from the analysis' emotion bit set to a
+        strategy, so no per-call string comparisons are needed.
+        
         Args:
-            emotional_analysis (dict): Output from EmotionalIntelligenceEngine.
-                                       Contains: primaryemotions, sentiment, 
-                                       cognitivedistortions, crisislevel
+            emotional_analysis (AnalysisResult): Output from EmotionalIntelligenceEngine.
+                                       Provides: primary_emotions, sentiment, 
+                                       cognitive_distortions, crisis_level
+            conversation_state (dict, optional): ConversationStateTracker.snapshot()
+                                       of the session the message belongs to.
         
         Returns:
             str: Strategy name (one of the keys in self.therapy_approaches)
         """
         
         # RULE 1: SAFETY FIRST
-        if emotional_analysis["crisislevel"] == "high":
-            return "crisis_intervention"
+        if emotional_analysis.crisis:
+            return self.crisis_strategy
         
-        # RULE 2: EMOTION-BASED STRATEGY SELECTION
-        primary_emotions = emotional_analysis.get("primaryemotions", [])
+        # RULE 2: EMOTION-BASED STRATEGY SELECTION (one table lookup on the emotion bits)
+        labels = emotional_analysis.labels
+        rules = self._compiled_rules(labels.emotions)
+        strategy = rules.for_bits(emotional_analysis.emotion_bits)
+        if strategy:
+            return strategy
         
-        if primary_emotions:
-            # Check emotions in order of clinical severity
-            if "trauma" in primary_emotions:
-                return "trauma_informed"
-            elif "anxiety" in primary_emotions:
-                return "anxiety_focused"
-            elif "depression" in primary_emotions:
-                return "depression_focused"
-            elif "relationships" in primary_emotions:
-                return "relationship_focused"
+        # RULE 2b: CONVERSATION CONTEXT
+        if conversation_state:
+            strategy = rules.for_emotions(labels.emotion_mask(conversation_state["dominant_emotions"]))
+            if strategy:
+                return strategy
         
         # RULE 3: COGNITIVE DISTORTION FALLBACK
-        if emotional_analysis.get("cognitivedistortions"):
-            return "cognitive_restructuring"
+        if emotional_analysis.distortion_bits and self.distortion_strategy:
+            return self.distortion_strategy
         
         # RULE 4: DEFAULT APPROACH
         # Cognitive restructuring is a foundational CBT technique,
         # always applicable and therapeutically sound.
-        return "cognitive_restructuring"
+        return DEFAULT_STRATEGY
+
+    def select_strategies(self, batch):
+        """
+        Vectorized select_strategy for the columnar output of
+        EmotionalIntelligenceEngine.analyze_emotional_states. Applies the same
+        rules (without conversation context) to every row at once, as masks
+        over the packed emotion bits instead of per-row branching.
+
+        Returns:
+            numpy array of strategy names, one per row of the batch.
+        """
+        strategies = list(self.therapy_approaches)
+        codes = {strategy: code for code, strategy in enumerate(strategies)}
+        rules = self._compiled_rules(tuple(batch["emotions"]))
+
+        # Same bit sets as AnalysisResult, then the primary (first two) emotions of every row
+        emotion_bits = (batch["emotion_flags"].astype(np.int64)
+                        << np.arange(len(batch["emotions"]), dtype=np.int64)).sum(axis=1)
+        first = emotion_bits & -emotion_bits
+        rest = emotion_bits ^ first
+        primary = first | (rest & -rest)
+
+        # Apply the rules lowest priority first, so higher-priority rules overwrite
+        result = np.full(len(emotion_bits), codes[DEFAULT_STRATEGY], dtype=np.int16)
+        if self.distortion_strategy:
+            result[batch["distortion_flags"].any(axis=1)] = codes[self.distortion_strategy]
+        for mask, strategy in reversed(rules.emotion_rules):
+            result[(primary & mask) != 0] = codes[strategy]
+        result[batch["crisis"]] = codes[self.crisis_strategy]
+        return np.array(strategies, dtype=object)[result]
+
+    def _compiled_rules(self, emotions):
+        # Compiled once per emotion label order (patterns can be reloaded)
+        rules = self._rules_cache.get(emotions)
+        if rules is None:
+            rules = self._rules_cache.setdefault(emotions, _CompiledRules(emotions))
+        return rules
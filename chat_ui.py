@@ -0,0 +1,44 @@
+import gradio as gr
+
+EXAMPLES = [
+    ["I'm so worried about my presentation tomorrow, I feel like I'm going to fail."],
+    ["I've been feeling so down lately, nothing seems interesting anymore."],
+]
+
+
+def _session_id(request):
+    # None (the engine's default session) outside a browser session, e.g. in tests
+    return getattr(request, "session_hash", None)
+
+
+def build_chat_interface(generation_engine, stream=True):
+    """
+    Gradio ChatInterface for a UltimateGenerationEngine.
+
+    With stream=True the chat function is a generator over
+    generate_master_response_stream, so the reply appears word by word as the
+    model writes it instead of after the whole generation; if the client
+    goes away, Gradio closes the generator and generation stops. With
+    stream=False it awaits agenerate, so Gradio's event loop is not blocked
+    and a cancelled request stops generating.
+
+    Every browser session gets its own conversation (keyed by Gradio's
+    session hash), so concurrent users never see each other's history.
+    """
+    async def chat_function(message, history, request: gr.Request):
+        """Gradio calls this function for every message."""
+        response, _, _ = await generation_engine.agenerate(_session_id(request), message)
+        return response
+
+    def stream_chat_function(message, history, request: gr.Request):
+        """Gradio calls this generator for every message and shows each yielded text."""
+        yield from generation_engine.generate_master_response_stream(message, session_id=_session_id(request))
+
+    return gr.ChatInterface(
+        fn=stream_chat_function if stream else chat_function,
+        title="🧠 Ultimate CBT Therapist AI --> BE WHO YOU ARE!",
+        description="This is a fine-tuned microsoft/phi-2 model, running on a T4 GPU, designed to provide support using CBT principles.",
+        theme="soft",
+        examples=EXAMPLES,
+        chatbot=gr.Chatbot(height=400),  # Set chatbot height
+    )
@@ -0,0 +1,128 @@
+import threading
+from collections import deque
+
+# Weight a detected emotion adds to its running score, by intensity
+INTENSITY_WEIGHTS = {"mild": 1.0, "moderate": 2.0, "severe": 3.0}
+
+
+class ConversationStateTracker:
+    """
+    Running emotional state of one conversation.
+
+    Every turn's analysis (from EmotionalIntelligenceEngine) is folded into
+    a set of aggregates as it arrives, so reading the conversation-level
+    state never means re-analyzing earlier turns:
+
+        emotion_weights: exponentially decayed emotion scores. Each turn
+            multiplies all weights by `decay`, then adds the intensity weight
+            of every emotion detected in the new message.
+        distortion_counts: how many turns showed each cognitive distortion.
+        sentiment_ewma / sentiment_trend: moving average of VADER compound,
+            and its least-squares slope per turn over the last
+            `trend_window` scored turns (negative means things are getting worse).
+        crisis_turns: indices of the most recent high-crisis turns.
+
+    update() does a fixed amount of work per turn, however long the
+    conversation gets. It is thread-safe; snapshot() returns a plain dict
+    copy for the strategy engine and for dashboards, and preview() the
+    snapshot a turn would lead to, without applying it.
+    """
+
+    def __init__(self, decay=0.8, trend_window=5, crisis_history=20):
+        self.decay = decay
+        self.trend_window = trend_window
+        self._lock = threading.Lock()
+        self._crisis_history = crisis_history
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.turns = 0
+            self.emotion_weights = {}
+            self.distortion_counts = {}
+            self.sentiment_ewma = None
+            self._recent_compound = deque(maxlen=self.trend_window)
+            self.crisis_count = 0
+            self.crisis_turns = deque(maxlen=self._crisis_history)
+
+    def update(self, analysis):
+        """
+        Fold one turn's analysis into the running state. Analyses from the
+        crisis fast path carry no sentiment; those turns leave the sentiment
+        aggregates unchanged.
+        """
+        with self._lock:
+            turn = self.turns
+            self.turns += 1
+
+            weights = self.emotion_weights
+            for emotion in weights:
+                weights[emotion] *= self.decay
+            for emotion, intensity in analysis.emotion_intensities.items():
+                weights[emotion] = weights.get(emotion, 0.0) + INTENSITY_WEIGHTS.get(intensity, 1.0)
+
+            for distortion in analysis.cognitive_distortions:
+                self.distortion_counts[distortion] = self.distortion_counts.get(distortion, 0) + 1
+
+            compound = analysis.compound
+            if compound is not None:
+                if self.sentiment_ewma is None:
+                    self.sentiment_ewma = compound
+                else:
+                    self.sentiment_ewma = (1 - self.decay) * compound + self.decay * self.sentiment_ewma
+                self._recent_compound.append(compound)
+
+            if analysis.crisis:
+                self.crisis_count += 1
+                self.crisis_turns.append(turn)
+
+    def preview(self, analysis):
+        """snapshot() as it would be after update(analysis), leaving this tracker unchanged."""
+        draft = ConversationStateTracker(self.decay, self.trend_window, self._crisis_history)
+        with self._lock:
+            draft.turns = self.turns
+            draft.emotion_weights = dict(self.emotion_weights)
+            draft.distortion_counts = dict(self.distortion_counts)
+            draft.sentiment_ewma = self.sentiment_ewma
+            draft._recent_compound.extend(self._recent_compound)
+            draft.crisis_count = self.crisis_count
+            draft.crisis_turns.extend(self.crisis_turns)
+        draft.update(analysis)
+        return draft.snapshot()
+
+    @property
+    def sentiment_trend(self):
+        # Slope of compound over the last trend_window scored turns (bounded work)
+        values = list(self._recent_compound)
+        n = len(values)
+        if n < 2:
+            return 0.0
+        mean_x, mean_y = (n - 1) / 2, sum(values) / n
+        covariance = sum((x - mean_x) * (y - mean_y) for x, y in enumerate(values))
+        variance = sum((x - mean_x) ** 2 for x in range(n))
+        return covariance / variance
+
+    def dominant_emotions(self, k=2, min_weight=0.5):
+        """Emotions with the highest decayed weight, strongest first."""
+        ranked = sorted(self.emotion_weights.items(), key=lambda item: -item[1])
+        return [emotion for emotion, weight in ranked[:k] if weight >= min_weight]
+
+    def turns_since_crisis(self):
+        """Turns since the last high-crisis turn (0 means this turn), or None if there never was one."""
+        if not self.crisis_turns:
+            return None
+        return self.turns - 1 - self.crisis_turns[-1]
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "turns": self.turns,
+                "dominant_emotions": self.dominant_emotions(),
+                "emotion_weights": {e: round(w, 4) for e, w in self.emotion_weights.items()},
+                "distortion_counts": dict(self.distortion_counts),
+                "sentiment_ewma": self.sentiment_ewma,
+                "sentiment_trend": self.sentiment_trend,
+                "crisis_count": self.crisis_count,
+                "crisis_turns": list(self.crisis_turns),
+                "turns_since_crisis": self.turns_since_crisis(),
+            }
@@ -0,0 +1,107 @@
+import threading
+
+import numpy as np
+
+_registry_lock = threading.Lock()
+_classifiers = {}
+
+
+def _normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms == 0, 1.0, norms)
+
+
+class EmbeddingEmotionClassifier:
+    """
+    Emotion and distortion classifier on top of a sentence embedding.
+
+    Every emotion and distortion gets a centroid: the mean of the normalized
+    embeddings of its vocabulary phrases (keywords and intensity markers for
+    emotions, patterns for distortions) plus any extra prototype sentences.
+    The centroids form one matrix, so classifying a message is a single
+    matrix-vector product of cosine similarities against every label.
+
+    The classifier does not embed messages itself: it is given the embedding
+    RAGKnowledgeEngine already computed for the query, so no extra model is
+    loaded and each message is embedded once per turn. Its hits supplement
+    the keyword matcher's, they never replace them, and crisis detection
+    stays keyword-only.
+
+    Experimental: the default thresholds are placeholders that have not been
+    calibrated against labelled messages, and centroids built from single
+    generic words (the "always" or "should" of allornothing and
+    shouldstatements) sit close to ordinary messages. Pass thresholds
+    measured on your own data and prototype sentences before relying on it.
+    """
+
+    def __init__(self, emotions, distortions, centroids, emotion_threshold=0.45, distortion_threshold=0.45):
+        self.emotions = tuple(emotions)
+        self.distortions = tuple(distortions)
+        self.centroids = _normalize_rows(np.asarray(centroids, dtype=np.float32))
+        self.thresholds = np.array([emotion_threshold] * len(self.emotions)
+                                   + [distortion_threshold] * len(self.distortions), dtype=np.float32)
+
+    @classmethod
+    def from_patterns(cls, embed, emotion_patterns, cognitive_distortions, prototypes=None, **thresholds):
+        """
+        Build the centroid matrix by embedding the pattern vocabularies with
+        `embed` (a callable mapping a list of texts to a list of vectors, such
+        as RAGKnowledgeEngine.embedding_fn). prototypes optionally maps a label
+        to extra example sentences. Classifiers are shared per embedding
+        function and vocabulary, so this embeds the phrases once per process.
+        """
+        prototypes = prototypes or {}
+        phrases = {emotion: list(p["keywords"]) + list(p.get("intensity_markers", []))
+                   for emotion, p in emotion_patterns.items()}
+        phrases.update({distortion: list(p) for distortion, p in cognitive_distortions.items()})
+        for label, sentences in prototypes.items():
+            phrases[label] = phrases.get(label, []) + list(sentences)
+
+        key = (id(embed), tuple((label, tuple(p)) for label, p in phrases.items()),
+               tuple(emotion_patterns), tuple(sorted(thresholds.items())))
+        entry = _classifiers.get(key)
+        if entry is not None:
+            return entry[1]
+
+        labels = list(emotion_patterns) + list(cognitive_distortions)
+        flat = [phrase for label in labels for phrase in phrases[label]]
+        vectors = _normalize_rows(np.asarray(embed(flat), dtype=np.float32))
+        owners = np.repeat(np.arange(len(labels)), [len(phrases[label]) for label in labels])
+        centroids = np.zeros((len(labels), vectors.shape[1]), dtype=np.float32)
+        np.add.at(centroids, owners, vectors)
+
+        classifier = cls(emotion_patterns, cognitive_distortions, centroids, **thresholds)
+        with _registry_lock:
+            # The embedding function is kept alive with the entry so its id is not reused
+            return _classifiers.setdefault(key, (embed, classifier))[1]
+
+    def scores(self, embedding):
+        """Cosine similarity of one embedding to every centroid: (emotion scores, distortion scores)."""
+        similarity = self.centroids @ _normalize_rows(np.asarray(embedding, dtype=np.float32))
+        return similarity[:len(self.emotions)], similarity[len(self.emotions):]
+
+    def classify(self, embedding):
+        """Return (emotions, distortions) whose similarity clears the threshold, in table order."""
+        similarity = self.centroids @ _normalize_rows(np.asarray(embedding, dtype=np.float32))
+        hits = similarity >= self.thresholds
+        n = len(self.emotions)
+        return ([e for e, hit in zip(self.emotions, hits[:n]) if hit],
+                [d for d, hit in zip(self.distortions, hits[n:]) if hit])
+
+    def merge(self, analysis, embedding):
+        """
+        Add the labels found in the embedding to a keyword AnalysisResult.
+        Emotions found only this way are graded "mild".
+        """
+        emotions, distortions = self.classify(embedding)
+        labels = analysis.labels
+        new_emotions = labels.emotion_mask(emotions) & ~analysis.emotion_bits
+        if not new_emotions and not labels.distortion_mask(distortions) & ~analysis.distortion_bits:
+            return analysis
+        intensity_bits = analysis.intensity_bits
+        for index in range(len(labels.emotions)):
+            if new_emotions >> index & 1:
+                intensity_bits |= 1 << 2 * index
+        return analysis.replace(emotion_bits=analysis.emotion_bits | new_emotions,
+                                intensity_bits=intensity_bits,
+                                distortion_bits=analysis.distortion_bits | labels.distortion_mask(distortions))
@@ -0,0 +1,550 @@
+import threading
+import time
+from collections import deque
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from transformers import DynamicCache, LogitsProcessor, LogitsProcessorList, StoppingCriteria, StoppingCriteriaList
+
+from kv_cache import cache_layers
+
+
+class SamplingParams:
+    """Decoding settings of one request, with the same meaning as the model.generate arguments."""
+
+    def __init__(self, max_new_tokens=250, min_new_tokens=0, do_sample=True, temperature=1.0, top_p=1.0,
+                 repetition_penalty=1.0, seed=None):
+        self.max_new_tokens = max_new_tokens
+        self.min_new_tokens = min_new_tokens
+        self.do_sample = do_sample
+        self.temperature = temperature
+        self.top_p = top_p
+        self.repetition_penalty = repetition_penalty
+        self.seed = seed
+
+
+class GenerationRequest:
+    """
+    One sequence handed to a scheduler. `done` is set when it has finished;
+    output_ids then holds the generated token ids (ending with EOS if that is
+    what stopped it) and finish_reason is "eos", "length", "stop" (a stopping
+    criterion fired) or "cancelled".
+
+    cancel() (or setting the cancel_event passed in) abandons the request: it
+    is dropped before its next decode step, and never prefilled if it is
+    still waiting.
+    """
+
+    def __init__(self, input_ids, params, stopping_criteria=None, cancel_event=None):
+        self.input_ids = [int(token) for token in input_ids]
+        self.params = params
+        self.stopping_criteria = stopping_criteria
+        self.cancel_event = cancel_event or threading.Event()
+        self.output_ids = []
+        self.finish_reason = None
+        self.error = None
+        self.done = threading.Event()
+        self.generator = None
+        if params.seed is not None:
+            self.generator = torch.Generator().manual_seed(params.seed)
+        self.submitted = time.perf_counter()
+        self.first_token_time = None
+        self.finished = None
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def result(self, timeout=None):
+        """Wait for the request to finish and return its output_ids."""
+        if not self.done.wait(timeout):
+            raise TimeoutError("Generation request did not finish in time")
+        if self.error is not None:
+            raise self.error
+        return self.output_ids
+
+
+class _RequestQueue:
+    # Queueing, threading and the blocking generate() shared by the schedulers below
+
+    def __init__(self, model, eos_token_id, max_batch_size, device):
+        self.model = model
+        self.eos_token_id = eos_token_id
+        self.max_batch_size = max_batch_size
+        if device is not None:
+            model.to(device)
+        self.device = model.device
+        self._waiting = deque()
+        self._condition = threading.Condition()
+        self._step_lock = threading.Lock()
+        self._thread = None
+        self._running = False
+        self.generated_tokens = 0
+
+    @property
+    def waiting(self):
+        return len(self._waiting)
+
+    def submit(self, input_ids, params=None, stopping_criteria=None, cancel_event=None):
+        """Queue one prompt (a 1-D sequence of token ids). Returns its GenerationRequest."""
+        request = GenerationRequest(input_ids, params or SamplingParams(), stopping_criteria, cancel_event)
+        with self._condition:
+            self._waiting.append(request)
+            self._condition.notify()
+        return request
+
+    def generate(self, input_ids, params=None, stopping_criteria=None, timeout=None, cancel_event=None):
+        """
+        Submit a prompt and wait for its generated token ids. Without a
+        background loop (start()), the caller's thread drives the loop until
+        the request is done.
+        """
+        request = self.submit(input_ids, params, stopping_criteria, cancel_event)
+        if self._thread is None:
+            while not request.done.is_set():
+                self.step()
+        return request.result(timeout)
+
+    def start(self):
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._loop, name="generation-scheduler", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _loop(self):
+        while True:
+            with self._condition:
+                while self._running and self._idle():
+                    self._condition.wait()
+                if not self._running:
+                    return
+            self.step()
+
+    def _idle(self):
+        return not self._waiting
+
+    def _finish(self, request, reason=None, error=None):
+        request.finish_reason = reason
+        request.error = error
+        request.finished = time.perf_counter()
+        request.done.set()
+        return True
+
+
+class ContinuousBatchingScheduler(_RequestQueue):
+    """
+    Shared decode loop for requests from many chat sessions.
+
+    Requests wait in a queue until there is room in the batch (max_batch_size
+    rows). A new request is prefilled on its own and its keys/values are then
+    merged into the running batch, left-padded to a common length, so it joins
+    at the next decode step without waiting for the others to finish. Every
+    step decodes one token for all rows at once; rows that hit EOS, their
+    max_new_tokens or one of their stopping criteria leave the batch right
+    away and make room for waiting requests. Each request keeps its own
+    sampling parameters and stopping criteria.
+
+    Call start() to run the loop in a background thread, or step() to drive it
+    yourself. Nothing in the loop is GPU-specific: device="cpu" moves the
+    model to the CPU, e.g. to benchmark a small causal LM without a GPU (see
+    benchmark_generation.py).
+    """
+
+    def __init__(self, model, eos_token_id, max_batch_size=8, device=None):
+        super().__init__(model, eos_token_id, max_batch_size, device)
+        self._active = []
+        # Running batch: left-padded KV cache, its attention mask, and the
+        # last sampled token of every row (not yet in the cache)
+        self._cache = None
+        self._mask = None
+        self._pending = None
+        self.steps = 0
+        self.batch_rows = 0
+
+    @property
+    def active(self):
+        return len(self._active)
+
+    @property
+    def mean_batch_rows(self):
+        """Average number of rows decoded per step."""
+        return self.batch_rows / self.steps if self.steps else 0.0
+
+    def _idle(self):
+        return not self._waiting and not self._active
+
+    def step(self):
+        """
+        Admit waiting requests into free rows, then decode one token for every
+        row. Returns the number of rows still running.
+        """
+        with self._step_lock:
+            try:
+                with torch.no_grad():
+                    self._admit()
+                    if self._active:
+                        self._decode()
+            except Exception as exc:
+                self._fail_all(exc)
+            return len(self._active)
+
+    def _admit(self):
+        while len(self._active) < self.max_batch_size:
+            with self._condition:
+                if not self._waiting:
+                    return
+                request = self._waiting.popleft()
+            if request.cancelled:
+                self._finish(request, "cancelled")
+                continue
+            input_ids = torch.tensor([request.input_ids], dtype=torch.long, device=self.device)
+            try:
+                outputs = self.model(input_ids=input_ids, use_cache=True)
+                token = self._sample(outputs.logits[:, -1, :], [request])[0]
+            except Exception as exc:
+                self._finish(request, error=exc)
+                continue
+            if self._advance(request, token):
+                continue
+            self._join(request, outputs.past_key_values, input_ids.shape[1], token)
+
+    def _join(self, request, past_key_values, length, token):
+        # Left-pad the new row and the running batch to a common cache length
+        pending = torch.tensor([token], dtype=torch.long, device=self.device)
+        mask = torch.ones((1, length), dtype=torch.long, device=self.device)
+        if self._cache is None:
+            self._cache, self._mask, self._pending = past_key_values, mask, pending
+        else:
+            current = self._mask.shape[1]
+            total = max(current, length)
+            layers = [(torch.cat([_left_pad(keys, total - current), _left_pad(new_keys, total - length)]),
+                       torch.cat([_left_pad(values, total - current), _left_pad(new_values, total - length)]))
+                      for (keys, values), (new_keys, new_values)
+                      in zip(cache_layers(self._cache), cache_layers(past_key_values))]
+            self._cache = DynamicCache(layers)
+            self._mask = torch.cat([F.pad(self._mask, (total - current, 0)), F.pad(mask, (total - length, 0))])
+            self._pending = torch.cat([self._pending, pending])
+        self._active.append(request)
+
+    def _decode(self):
+        cancelled = [request for request in self._active if request.cancelled]
+        if cancelled:
+            for request in cancelled:
+                self._finish(request, "cancelled")
+            self._retire([row for row, request in enumerate(self._active) if request not in cancelled])
+            if not self._active:
+                return
+        mask = torch.cat([self._mask, torch.ones_like(self._mask[:, :1])], dim=1)
+        # Positions count real tokens only, so left padding does not shift them
+        position_ids = (mask.sum(dim=1, keepdim=True) - 1)
+        outputs = self.model(input_ids=self._pending[:, None], attention_mask=mask, position_ids=position_ids,
+                             past_key_values=self._cache, use_cache=True)
+        self._cache, self._mask = outputs.past_key_values, mask
+        tokens = self._sample(outputs.logits[:, -1, :], self._active)
+        self.steps += 1
+        self.batch_rows += len(self._active)
+
+        keep = [row for row, (request, token) in enumerate(zip(self._active, tokens))
+                if not self._advance(request, token)]
+        self._pending = torch.tensor(tokens, dtype=torch.long, device=self.device)
+        if len(keep) < len(self._active):
+            self._retire(keep)
+
+    def _retire(self, keep):
+        # Drop finished rows, then any leading columns that are padding in every remaining row
+        self._active = [self._active[row] for row in keep]
+        if not keep:
+            self._cache = self._mask = self._pending = None
+            return
+        index = torch.tensor(keep, dtype=torch.long, device=self.device)
+        mask = self._mask.index_select(0, index)
+        start = int(mask.any(dim=0).nonzero()[0, 0])
+        self._mask = mask[:, start:]
+        self._pending = self._pending.index_select(0, index)
+        self._cache = DynamicCache([(keys.index_select(0, index)[:, :, start:], values.index_select(0, index)[:, :, start:])
+                                    for keys, values in cache_layers(self._cache)])
+
+    def _sample(self, logits, requests):
+        tokens = []
+        for scores, request in zip(logits.float(), requests):
+            params = request.params
+            if params.repetition_penalty != 1.0:
+                seen = torch.tensor(request.input_ids + request.output_ids, device=scores.device).unique()
+                previous = scores[seen]
+                scores[seen] = torch.where(previous < 0, previous * params.repetition_penalty,
+                                           previous / params.repetition_penalty)
+            if len(request.output_ids) < params.min_new_tokens and self.eos_token_id is not None:
+                scores[self.eos_token_id] = -float("inf")
+            if not params.do_sample:
+                tokens.append(int(scores.argmax()))
+                continue
+            scores = scores / params.temperature
+            if params.top_p < 1.0:
+                sorted_scores, order = scores.sort(descending=True)
+                probs = sorted_scores.softmax(dim=-1)
+                # Keep the smallest set of tokens whose probability reaches top_p
+                outside = probs.cumsum(dim=-1) - probs >= params.top_p
+                scores[order[outside]] = -float("inf")
+            probs = scores.softmax(dim=-1)
+            generator = request.generator
+            if generator is not None and generator.device != probs.device:
+                generator = request.generator = torch.Generator(probs.device).manual_seed(params.seed)
+            tokens.append(int(torch.multinomial(probs, 1, generator=generator)))
+        return tokens
+
+    def _advance(self, request, token):
+        # Record a sampled token; returns True if the request is now finished
+        request.output_ids.append(token)
+        if request.first_token_time is None:
+            request.first_token_time = time.perf_counter()
+        self.generated_tokens += 1
+        params = request.params
+        if token == self.eos_token_id and len(request.output_ids) > params.min_new_tokens:
+            return self._finish(request, "eos")
+        if request.stopping_criteria is not None:
+            ids = torch.tensor([request.input_ids + request.output_ids], dtype=torch.long, device=self.device)
+            if bool(request.stopping_criteria(ids, None).all()):
+                return self._finish(request, "stop")
+        if len(request.output_ids) >= params.max_new_tokens:
+            return self._finish(request, "length")
+        return False
+
+    def _fail_all(self, exc):
+        for request in self._active:
+            self._finish(request, error=exc)
+        self._active = []
+        self._cache = self._mask = self._pending = None
+
+
+class MicroBatchingScheduler(_RequestQueue):
+    """
+    A simpler alternative to ContinuousBatchingScheduler. Requests that arrive
+    within window_ms of the oldest waiting one, up to max_batch_size of them,
+    are left-padded into one batch and decoded by a single model.generate
+    call. The batch runs until its last row finishes, so requests that arrive
+    in the meantime wait for the next batch.
+
+    Only requests with the same sampling parameters share a batch, apart from
+    min_new_tokens, max_new_tokens and repetition_penalty. Every row stops on its own at EOS, at
+    its max_new_tokens or on its stopping criteria, and its caller is woken right away, while
+    the rest of the batch carries on. Per-request seeds are not supported,
+    because the whole batch samples from one random stream.
+
+    A longer window gives larger batches and more aggregate tokens/sec, but
+    every request may then wait up to window_ms before it is decoded.
+    metrics() reports queue time and throughput by batch size for tuning
+    window_ms and max_batch_size.
+    """
+
+    def __init__(self, model, eos_token_id, pad_token_id=None, max_batch_size=8, window_ms=10.0, device=None,
+                 history=1000):
+        super().__init__(model, eos_token_id, max_batch_size, device)
+        self.pad_token_id = eos_token_id if pad_token_id is None else pad_token_id
+        self.window = window_ms / 1000
+        # One record per recent batch: its size, the queue time of each request,
+        # the tokens it generated and how long generate() took
+        self.batches = deque(maxlen=history)
+        self.batch_count = 0
+
+    @property
+    def mean_batch_rows(self):
+        """Average size of the recent batches."""
+        return sum(batch["size"] for batch in self.batches) / len(self.batches) if self.batches else 0.0
+
+    def step(self):
+        """
+        Collect a batch, waiting until the window of its oldest request has
+        passed or the batch is full, and generate it to completion. Returns
+        the batch size.
+        """
+        with self._step_lock:
+            batch = self._collect()
+            if not batch:
+                return 0
+            started = time.perf_counter()
+            try:
+                with torch.no_grad():
+                    self._generate(batch)
+            except Exception as exc:
+                for request in batch:
+                    if not request.done.is_set():
+                        self._finish(request, error=exc)
+            self._record(batch, started)
+            return len(batch)
+
+    def metrics(self):
+        """
+        Queue time and throughput by batch size over the recent batches:
+        {batch_size: {"batches", "p50_queue_ms", "p99_queue_ms", "tokens_per_sec"}}.
+        """
+        by_size = {}
+        for batch in self.batches:
+            by_size.setdefault(batch["size"], []).append(batch)
+        metrics = {}
+        for size, batches in sorted(by_size.items()):
+            queue_ms = [ms for batch in batches for ms in batch["queue_ms"]]
+            seconds = sum(batch["seconds"] for batch in batches)
+            metrics[size] = {
+                "batches": len(batches),
+                "p50_queue_ms": round(float(np.percentile(queue_ms, 50)), 1),
+                "p99_queue_ms": round(float(np.percentile(queue_ms, 99)), 1),
+                "tokens_per_sec": round(sum(batch["tokens"] for batch in batches) / seconds, 1) if seconds else 0.0,
+            }
+        return metrics
+
+    def _collect(self):
+        with self._condition:
+            if not self._waiting:
+                return []
+            oldest = self._waiting[0]
+            key = _batch_key(oldest.params)
+            deadline = oldest.submitted + self.window
+            while True:
+                batch = [request for request in self._waiting if _batch_key(request.params) == key]
+                batch = batch[:self.max_batch_size]
+                remaining = deadline - time.perf_counter()
+                if len(batch) >= self.max_batch_size or remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            for request in batch:
+                self._waiting.remove(request)
+        return self._drop_cancelled(batch)
+
+    def _drop_cancelled(self, requests):
+        kept = []
+        for request in requests:
+            if request.cancelled:
+                self._finish(request, "cancelled")
+            else:
+                kept.append(request)
+        return kept
+
+    def _generate(self, batch):
+        width = max(len(request.input_ids) for request in batch)
+        input_ids = torch.full((len(batch), width), self.pad_token_id, dtype=torch.long, device=self.device)
+        attention_mask = torch.zeros_like(input_ids)
+        for row, request in enumerate(batch):
+            length = len(request.input_ids)
+            input_ids[row, width - length:] = torch.tensor(request.input_ids, dtype=torch.long)
+            attention_mask[row, width - length:] = 1
+        params = batch[0].params
+        settings = {"do_sample": params.do_sample}
+        if params.do_sample:
+            settings.update(temperature=params.temperature, top_p=params.top_p)
+        self.model.generate(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            max_new_tokens=max(request.params.max_new_tokens for request in batch),
+            pad_token_id=self.pad_token_id,
+            eos_token_id=self.eos_token_id,
+            logits_processor=LogitsProcessorList([_RowLogits(self.eos_token_id, batch, width)]),
+            stopping_criteria=StoppingCriteriaList([_BatchRows(self, batch, width)]),
+            **settings,
+        )
+        # Rows still open here ran to the batch's max_new_tokens
+        for request in batch:
+            if not request.done.is_set():
+                self._finish(request, "length")
+
+    def _record(self, batch, started):
+        tokens = sum(len(request.output_ids) for request in batch)
+        self.generated_tokens += tokens
+        self.batch_count += 1
+        self.batches.append({
+            "size": len(batch),
+            "queue_ms": [(started - request.submitted) * 1000 for request in batch],
+            "tokens": tokens,
+            "seconds": time.perf_counter() - started,
+        })
+
+
+class _BatchRows(StoppingCriteria):
+    """
+    Per-row stopping for MicroBatchingScheduler. After every generate() step it
+    finishes the rows that produced EOS, reached their own max_new_tokens or
+    tripped their stopping criteria. Each finished request gets its tokens
+    and is released at that moment. generate() stops once every row is done.
+    """
+
+    def __init__(self, scheduler, batch, prompt_width):
+        self.scheduler = scheduler
+        self.batch = batch
+        self.prompt_width = prompt_width
+
+    def __call__(self, input_ids, scores, **kwargs):
+        generated = input_ids.shape[1] - self.prompt_width
+        last_tokens = input_ids[:, -1].tolist()
+        now = time.perf_counter()
+        for row, request in enumerate(self.batch):
+            if request.done.is_set():
+                continue
+            if request.cancelled:
+                self.scheduler._finish(request, "cancelled")
+                continue
+            if request.first_token_time is None:
+                request.first_token_time = now
+            params = request.params
+            reason = None
+            if last_tokens[row] == self.scheduler.eos_token_id and generated > params.min_new_tokens:
+                reason = "eos"
+            elif request.stopping_criteria is not None:
+                # The criteria see the row without its left padding
+                ids = input_ids[row:row + 1, self.prompt_width - len(request.input_ids):]
+                if bool(request.stopping_criteria(ids, scores).all()):
+                    reason = "stop"
+            if reason is None and generated >= params.max_new_tokens:
+                reason = "length"
+            request.output_ids = input_ids[row, self.prompt_width:].tolist()
+            if reason is not None:
+                self.scheduler._finish(request, reason)
+        return torch.tensor([request.done.is_set() for request in self.batch], device=input_ids.device)
+
+
+class _RowLogits(LogitsProcessor):
+    """
+    Per-row logits adjustments for MicroBatchingScheduler. The repetition
+    penalty covers only each row's own tokens, not its left padding (the pad
+    token is usually EOS, which would otherwise be penalized). EOS is masked
+    until each row has its own min_new_tokens.
+    """
+
+    def __init__(self, eos_token_id, batch, prompt_width):
+        self.eos_token_id = eos_token_id
+        self.batch = batch
+        self.prompt_width = prompt_width
+
+    def __call__(self, input_ids, scores):
+        generated = input_ids.shape[1] - self.prompt_width
+        for row, request in enumerate(self.batch):
+            params = request.params
+            if params.repetition_penalty != 1.0:
+                seen = input_ids[row, self.prompt_width - len(request.input_ids):].unique()
+                previous = scores[row, seen]
+                scores[row, seen] = torch.where(previous < 0, previous * params.repetition_penalty,
+                                                previous / params.repetition_penalty)
+            if generated < params.min_new_tokens and self.eos_token_id is not None:
+                scores[row, self.eos_token_id] = -float("inf")
+        return scores
+
+
+def _batch_key(params):
+    # Requests can share a model.generate call when these settings agree
+    return (params.do_sample, params.temperature, params.top_p)
+
+
+def _left_pad(tensor, length):
+    # Pad the sequence dimension of a (batch, heads, seq, head_dim) tensor on the left
+    return F.pad(tensor, (0, 0, length, 0)) if length else tensor
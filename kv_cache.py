@@ -0,0 +1,160 @@
+import copy
+import threading
+from collections import OrderedDict
+
+import torch
+
+# Default memory budget shared by all sessions of a SessionKVCache
+SESSION_CACHE_BUDGET_BYTES = 1 << 30
+
+
+def cache_layers(past_key_values):
+    """(keys, values) tensors of every layer of a transformers Cache."""
+    layers = getattr(past_key_values, "layers", None)
+    if layers is not None:
+        return [(layer.keys, layer.values) for layer in layers]
+    return list(zip(past_key_values.key_cache, past_key_values.value_cache))
+
+
+def cache_nbytes(past_key_values):
+    """Memory held by the key/value tensors of a transformers Cache."""
+    tensors = [t for pair in cache_layers(past_key_values) for t in pair]
+    return sum(t.numel() * t.element_size() for t in tensors if t is not None)
+
+
+class PrefixKVCache:
+    """
+    Precomputed past_key_values for fixed prompt prefixes.
+
+    Every generation prompt starts with the same instructions, so their keys
+    and values are computed once per prefix and reused: generate() gets the
+    full prompt as usual plus a copy of the cached prefix, and only prefills
+    the tokens after it (history, RAG snippets and the user message).
+
+    A cached prefix is only used when the tokenized prompt really starts with
+    the prefix's tokens, so a BPE merge across the boundary can never change
+    what the model sees; such prompts are simply prefilled in full.
+    """
+
+    def __init__(self, model, tokenizer):
+        self.model = model
+        self.tokenizer = tokenizer
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def warm(self, prefixes):
+        """Compute the cache for every prefix up front (duplicates are computed once)."""
+        for prefix in dict.fromkeys(prefixes):
+            self._entry(prefix)
+
+    def _entry(self, prefix):
+        entry = self._entries.get(prefix)
+        if entry is None:
+            ids = self.tokenizer(prefix, return_tensors="pt")["input_ids"].to(self.model.device)
+            with torch.no_grad():
+                past = self.model(input_ids=ids, use_cache=True).past_key_values
+            with self._lock:
+                entry = self._entries.setdefault(prefix, (ids, past))
+        return entry
+
+    def lookup(self, prefix, input_ids):
+        """
+        Return a private copy of the cached past_key_values for `prefix` if
+        input_ids (a single tokenized prompt) starts with the prefix's tokens
+        and continues past them, else None. generate() extends the cache it is
+        given in place, hence the copy.
+        """
+        ids, past = self._entry(prefix)
+        length = ids.shape[1]
+        if (input_ids.shape[0] != 1 or input_ids.shape[1] <= length
+                or not torch.equal(input_ids[0, :length], ids[0])):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return copy.deepcopy(past)
+
+
+class SessionKVCache:
+    """
+    past_key_values kept from one turn of a conversation to the next.
+
+    After a turn, the cache that generate() built for the prompt and reply is
+    stored under the session id together with its token ids. take() hands it
+    back cropped to the longest token prefix shared with the next turn's
+    prompt, and only the rest is prefilled. The history comes before the
+    retrieved knowledge in the prompt, so that prefix normally reaches the
+    end of the earlier turns. The previous turn's RAG block, message and
+    reply are prefilled again, since the reply is stored polished and the
+    knowledge changes with the message. When the memory deque drops its
+    oldest turn, the shared prefix shrinks to the preamble and the cache is
+    rebased there. UltimateGenerationEngine.session_cache_summary() reports
+    how often each happens.
+
+    Entries are evicted least recently used first once all sessions together
+    hold more than max_bytes of keys and values.
+    """
+
+    def __init__(self, max_bytes=SESSION_CACHE_BUDGET_BYTES):
+        self.max_bytes = max_bytes
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.reused_tokens = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def take(self, session_id, input_ids):
+        """
+        Remove the session's cache and return (past_key_values, reused), the
+        cache cropped to the tokens it shares with input_ids (always leaving
+        at least one token to prefill) and that token count, or (None, 0).
+        """
+        with self._lock:
+            entry = self._sessions.pop(session_id, None)
+            if entry is not None:
+                self.nbytes -= entry[2]
+        if entry is None or input_ids.shape[0] != 1:
+            return None, 0
+
+        ids, past_key_values, _ = entry
+        length = min(ids.shape[0], input_ids.shape[1] - 1)
+        mismatch = (ids[:length] != input_ids[0, :length].to(ids.device)).nonzero()
+        common = int(mismatch[0, 0]) if len(mismatch) else length
+        if common <= 0:
+            return None, 0
+        extra = past_key_values.get_seq_length() - common
+        if extra > 0:
+            past_key_values.crop(-extra)
+        self.reused_tokens += common
+        return past_key_values, common
+
+    def store(self, session_id, sequence_ids, past_key_values):
+        """Keep the cache generate() returned for this session's turn (sequence_ids: its 1-D output ids)."""
+        ids = sequence_ids[:past_key_values.get_seq_length()]
+        nbytes = cache_nbytes(past_key_values)
+        with self._lock:
+            previous = self._sessions.pop(session_id, None)
+            if previous is not None:
+                self.nbytes -= previous[2]
+            if nbytes > self.max_bytes:
+                return
+            self._sessions[session_id] = (ids, past_key_values, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, _, evicted) = self._sessions.popitem(last=False)
+                self.nbytes -= evicted
+                self.evictions += 1
+
+    def drop(self, session_id):
+        """Forget a session's cache (e.g. when the conversation is reset)."""
+        with self._lock:
+            entry = self._sessions.pop(session_id, None)
+            if entry is not None:
+                self.nbytes -= entry[2]
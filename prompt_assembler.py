@@ -0,0 +1,277 @@
+import threading
+from collections import OrderedDict
+
+import torch
+
+RAG_HEADER = "Relevant Knowledge (use if helpful, otherwise ignore):\n"
+
+# A short conversation in the prompt layout, to test how the tokenizer handles segment boundaries
+_SAMPLE_SNIPPETS = ["Slow breathing calms the body.", "Thoughts are not facts."]
+_SAMPLE_TURNS = [{"user": "I can't sleep.", "assistant": "That sounds hard."},
+                 {"user": "Work is too much.", "assistant": "What part feels heaviest?"}]
+
+
+class PromptSegment:
+    """
+    One piece of a prompt: `content` between fixed `before` and `after` text
+    (e.g. "- " and "\\n" around a RAG snippet), with the token ids of the
+    whole text. kind is "system", "rag", "history", "input" or "separator".
+    """
+
+    def __init__(self, kind, content, ids, before="", after=""):
+        self.kind = kind
+        self.content = content
+        self.ids = ids
+        self.before = before
+        self.after = after
+
+    @property
+    def text(self):
+        return f"{self.before}{self.content}{self.after}"
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class AssembledPrompt:
+    """
+    The segments kept for a prompt, in prompt order, how many were dropped
+    or trimmed, and the prompt's token ids (1-D tensor).
+    """
+
+    def __init__(self, segments, dropped, trimmed, input_ids):
+        self.segments = segments
+        self.dropped = dropped
+        self.trimmed = trimmed
+        self.input_ids = input_ids
+
+    @property
+    def text(self):
+        return "".join(segment.text for segment in self.segments)
+
+    @property
+    def tokens(self):
+        return len(self.input_ids)
+
+    def end_of(self, kind):
+        """
+        Token offset just after the first segment of this kind, or None if
+        there is none. Summed from segment lengths, so exact when the segment
+        ids are the prompt ids (PromptAssembler.segments_exact).
+        """
+        offset = 0
+        for segment in self.segments:
+            offset += len(segment)
+            if segment.kind == kind:
+                return offset
+        return None
+
+
+class PromptAssembler:
+    """
+    Builds generation prompts within a hard token budget (max_tokens).
+
+    The system text and the user's message are always kept; the message is
+    trimmed (keeping its end) only if it alone would not fit. The tokens
+    left are shared between RAG snippets and conversation history. RAG is
+    guaranteed rag_share of them, and history gets the rest, including
+    whatever RAG does not need. RAG can in turn use what history leaves.
+    The lowest-value segments go first. The lowest-ranked RAG snippets are
+    dropped, and the last snippet that partly fits is trimmed if at least
+    min_trim_tokens of it fit. History turns are dropped oldest first.
+    Prefill length, and with it prefill latency, is therefore bounded
+    however long a session runs.
+
+    chat_prompt() lays out the therapist prompt: the system text, the
+    remembered "User:/Therapist:" turns, the RAG block ("Relevant Knowledge"
+    and one "- snippet" line per document) and the message. The retrieved
+    knowledge changes with almost every message, so it comes after the
+    history: a turn's prompt then repeats the previous one up to its last
+    exchange, which a session KV cache can reuse.
+
+    Token ids are cached per segment text (up to cache_size segments), so
+    the remembered turns, the system text and recurring snippets are
+    tokenized once, not on every turn. check_segments() tests whether the
+    concatenated segment ids are exactly the ids of the joined text for this
+    tokenizer. If they are, they are used as the prompt ids directly.
+    Otherwise the joined text is tokenized, and segments are dropped until
+    that fits the budget.
+    """
+
+    def __init__(self, tokenizer, max_tokens=1536, rag_share=0.35, min_trim_tokens=32, cache_size=4096):
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.rag_share = rag_share
+        self.min_trim_tokens = min_trim_tokens
+        self.cache_size = cache_size
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.segments_exact = False
+
+    def encode(self, text, first=False):
+        """Token ids of text as a 1-D tensor. first: the text starts the prompt (special tokens added)."""
+        key = (text, first)
+        with self._lock:
+            ids = self._ids.get(key)
+            if ids is not None:
+                self._ids.move_to_end(key)
+                self.hits += 1
+                return ids
+        if text:
+            ids = self.tokenizer(text, return_tensors="pt", add_special_tokens=first)["input_ids"][0].cpu()
+        else:
+            ids = torch.zeros(0, dtype=torch.long)
+        with self._lock:
+            self.misses += 1
+            self._ids[key] = ids
+            if len(self._ids) > self.cache_size:
+                self._ids.popitem(last=False)
+        return ids
+
+    def check_segments(self, texts):
+        """
+        Set segments_exact: whether tokenizing texts one by one and
+        concatenating the ids gives the ids of the joined text. texts should
+        be a typical prompt cut at the segment boundaries.
+        """
+        joined = self.encode("".join(texts), first=True)
+        separate = torch.cat([self.encode(text, first=index == 0) for index, text in enumerate(texts)])
+        self.segments_exact = torch.equal(joined, separate)
+        return self.segments_exact
+
+    def check_chat_segments(self, system):
+        """check_segments() on a sample chat prompt with the given system text."""
+        rag, (history, user) = self.rag_segments(_SAMPLE_SNIPPETS), self.history_segments(_SAMPLE_TURNS, "Thanks.")
+        separator = self.segment("separator", "\n")
+        texts = [system]
+        for segment in history:
+            texts += [segment.text, separator.text]
+        texts += [RAG_HEADER] + [segment.text for segment in rag]
+        return self.check_segments(texts + [user.text])
+
+    def rag_segments(self, snippets):
+        """One segment per RAG snippet, in the order given (best first)."""
+        return [self.segment("rag", snippet, before="- ", after="\n") for snippet in snippets]
+
+    def history_segments(self, turns, user_input):
+        """
+        One segment per remembered turn (oldest first) and one for the message.
+        The blank line after a turn is split between the turn's own "\n" and a
+        separator segment, so every boundary falls at a single newline before
+        a letter. There, byte-level BPE tokenizers such as phi-2's give the
+        same ids as for the joined text.
+        """
+        history = [self.segment("history", f"User: {turn.get('user', '')}\nTherapist: {turn.get('assistant', '')}\n")
+                   for turn in turns]
+        return history, self.segment("input", user_input, before="User: ", after="\nTherapist:")
+
+    def chat_prompt(self, system, rag, history, max_tokens=None):
+        """
+        Assemble the therapist prompt from the system text, rag_segments() and
+        history_segments() within the budget. Returns an AssembledPrompt.
+        """
+        turns, user = history
+        return self.assemble(self.segment("system", system, first=True), rag, turns, user,
+                             rag_header=self.segment("rag", RAG_HEADER),
+                             history_separator=self.segment("separator", "\n"), max_tokens=max_tokens)
+
+    def segment(self, kind, content, before="", after="", first=False):
+        return PromptSegment(kind, content, self.encode(f"{before}{content}{after}", first), before, after)
+
+    def trim(self, segment, max_tokens, keep="start"):
+        """
+        The segment with its content cut to fit max_tokens, keeping the start
+        or the end of the content and marking the cut with "...". Returns None
+        if not even the fixed text fits.
+        """
+        content_ids = self.encode(segment.content)
+        keep_tokens = len(content_ids) - (len(segment) - max_tokens)
+        while keep_tokens > 0:
+            if keep == "start":
+                content = self.tokenizer.decode(content_ids[:keep_tokens]).rstrip() + "..."
+            else:
+                content = "..." + self.tokenizer.decode(content_ids[-keep_tokens:]).lstrip()
+            trimmed = self.segment(segment.kind, content, segment.before, segment.after)
+            if len(trimmed) <= max_tokens:
+                return trimmed
+            keep_tokens -= len(trimmed) - max_tokens
+        return None
+
+    def assemble(self, system, rag, history, user, rag_header=None, history_separator=None, max_tokens=None):
+        """
+        Pick the segments that fit max_tokens (default: self.max_tokens).
+
+        The prompt is system, history, rag, user. history: turn segments,
+        oldest first, each followed by history_separator. rag: snippet
+        segments, best first, preceded by rag_header if any is kept. Returns
+        an AssembledPrompt.
+        """
+        max_tokens = self.max_tokens if max_tokens is None else max_tokens
+        budget = max_tokens
+        while True:
+            segments, dropped, trimmed = self._select(system, rag, history, user, rag_header, history_separator,
+                                                      budget)
+            if self.segments_exact:
+                return AssembledPrompt(segments, dropped, trimmed, torch.cat([segment.ids for segment in segments]))
+            text = "".join(segment.text for segment in segments)
+            input_ids = self.tokenizer(text, return_tensors="pt")["input_ids"][0].cpu()
+            overflow = len(input_ids) - max_tokens
+            if overflow <= 0:
+                return AssembledPrompt(segments, dropped, trimmed, input_ids)
+            # Segment boundaries tokenize differently when joined; plan again with less room
+            budget -= overflow
+
+    def _select(self, system, rag, history, user, rag_header, history_separator, budget):
+        available = budget - len(system)
+        trimmed = 0
+        if len(user) > available:
+            user = self.trim(user, available, keep="end")
+            if user is None:
+                raise ValueError(f"Prompt budget of {budget} tokens is too small for the system text and message")
+            trimmed += 1
+        available -= len(user)
+
+        header = len(rag_header) if rag_header is not None else 0
+        separator = len(history_separator) if history_separator is not None else 0
+        rag_total = sum(len(segment) for segment in rag) + (header if rag else 0)
+        history_total = sum(len(segment) + separator for segment in history)
+        rag_budget = min(rag_total, max(int(available * self.rag_share), available - history_total))
+
+        # RAG, best snippets first, the last one that partly fits trimmed
+        snippets, used = [], header
+        for segment in rag:
+            room = rag_budget - used
+            if len(segment) > room:
+                if room >= self.min_trim_tokens:
+                    segment = self.trim(segment, room)
+                    if segment is not None:
+                        snippets.append(segment)
+                        used += len(segment)
+                        trimmed += 1
+                break
+            snippets.append(segment)
+            used += len(segment)
+        if snippets:
+            available -= used
+
+        # History, newest turns first
+        turns = []
+        for segment in reversed(history):
+            if len(segment) + separator > available:
+                break
+            turns.insert(0, segment)
+            available -= len(segment) + separator
+
+        segments = [system]
+        for segment in turns:
+            segments.append(segment)
+            if history_separator is not None:
+                segments.append(history_separator)
+        if snippets and rag_header is not None:
+            segments.append(rag_header)
+        segments.extend(snippets)
+        segments.append(user)
+        dropped = len(rag) - len(snippets) + len(history) - len(turns)
+        return segments, dropped, trimmed
@@ -1,17 +1,26 @@
 import chromadb
-from chromadb.utils import embeddingfunctions
+from chromadb.utils import embedding_functions
 
 class RAGKnowledgeEngine:
-    def __init__(self, persistpath="ragchromadb", collectionname="cbtknowledge", embeddingmodel="all-MiniLM-L6-v2"):
-        self.client = chromadb.PersistentClient(path=persistpath)
-        self.embeddingfn = embeddingfunctions.SentenceTransformerEmbeddingFunction(model_name=embeddingmodel)
+    def __init__(self, persist_path="rag_chroma_db", collection_name="cbt_knowledge", embedding_model="all-MiniLM-L6-v2"):
+        self.client = chromadb.PersistentClient(path=persist_path)
+        self.embedding_fn = embedding_functions.SentenceTransformerEmbeddingFunction(model_name=embedding_model)
         self.collection = self.client.get_or_create_collection(
-            name=collectionname, embedding_function=self.embeddingfn
+            name=collection_name, embedding_function=self.embedding_fn
         )
 
-    def retrieverelevantknowledge(self, querytext, k=3):
+    def embed_query(self, query_text):
+        """Embed a query once so retrieval and the emotion classifier can share it."""
+        return self.embedding_fn([query_text])[0]
+
+    def retrieve_relevant_knowledge(self, query_text, k=3, query_embedding=None):
         try:
-            results = self.collection.query(query_texts=[querytext], n_results=k)
-            return results.get("documents", [])[0]
+            if query_embedding is not None:
+                results = self.collection.query(query_embeddings=[query_embedding], n_results=k)
+            else:
+                results = self.collection.query(query_texts=[query_text], n_results=k)
+            docs = results.get("documents", [[]])[0]
+            metas = results.get("metadatas", [[]])[0] or [None] * len(docs)
+            return [{"content": doc, "metadata": meta} for doc, meta in zip(docs, metas)]
         except Exception:
             return []
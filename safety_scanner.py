@@ -0,0 +1,207 @@
+import threading
+
+from pattern_matcher import AhoCorasickMatcher
+
+# Sentence ends used to cut a reply back to the last complete sentence before unsafe content
+_SENTENCE_ENDS = ".!?\n"
+
+_registry_lock = threading.Lock()
+_output_matchers = {}
+
+
+def sentence_start(text, end=None):
+    """Offset just past the last sentence end in text[:end], i.e. where the sentence running into `end` starts."""
+    return max(text.rfind(mark, 0, end) for mark in _SENTENCE_ENDS) + 1
+
+
+def compile_output_patterns(crisis_keywords):
+    """
+    Build (or reuse) the matcher used on model output: crisis keywords with
+    payload ("crisis", keyword). Patterns are matched on lowercased,
+    whitespace-collapsed text, like the input-side matcher.
+    """
+    key = tuple(crisis_keywords)
+    matcher = _output_matchers.get(key)
+    if matcher is None:
+        matcher = AhoCorasickMatcher()
+        for keyword in crisis_keywords:
+            matcher.add(keyword.lower(), ("crisis", keyword))
+        matcher.build()
+        with _registry_lock:
+            matcher = _output_matchers.setdefault(key, matcher)
+    return matcher
+
+
+class StreamingSafetyScanner:
+    """
+    Incremental scanner for generated text.
+
+    Decoded chunks are fed in as they stream out of the model. Each chunk is
+    lowercased and its whitespace collapsed on the fly (runs that span two
+    chunks included), then advanced through the matcher starting from the
+    state the previous chunk ended in. A crisis keyword split across token
+    boundaries is therefore still found, and no text is scanned twice.
+
+    feed() returns the first hit whose kind is in stop_kinds, at which point
+    `stopped` is set and generation should be aborted. `text` is everything
+    fed so far, and safe_text() is the part of it that can still be shown.
+    """
+
+    def __init__(self, matcher, stop_kinds=("crisis",)):
+        self.matcher = matcher
+        self.stop_kinds = stop_kinds
+        # A match can reach back at most this many normalized characters
+        self._lookback = max((len(p) for p in matcher.patterns), default=0)
+        self.reset()
+
+    def reset(self):
+        self._state = 0
+        self._previous_space = True
+        self._tail_positions = []
+        self._chunks = []
+        self._length = 0
+        self.hits = []
+        self.stop_hit = None
+
+    @property
+    def stopped(self):
+        return self.stop_hit is not None
+
+    @property
+    def text(self):
+        return "".join(self._chunks)
+
+    def feed(self, chunk):
+        """
+        Scan the next piece of generated text. Returns the stopping hit (a
+        dict with kind, label, pattern, start, end; offsets index into
+        self.text) or None. Once stopped, further chunks are ignored.
+        """
+        if self.stop_hit is not None or not chunk:
+            return self.stop_hit
+        base = self._length
+        self._chunks.append(chunk)
+        self._length += len(chunk)
+
+        # Normalize the chunk, remembering where each kept character came from.
+        # positions starts with those of the previous chunks' last characters,
+        # so matches that straddle a boundary map back too.
+        normalized, positions = [], list(self._tail_positions)
+        carried = len(positions)
+        previous_space = self._previous_space
+        for index, ch in enumerate(chunk):
+            if ch.isspace():
+                if previous_space:
+                    continue
+                ch, previous_space = " ", True
+            else:
+                lowered = ch.lower()
+                ch, previous_space = (lowered if len(lowered) == 1 else ch), False
+            normalized.append(ch)
+            positions.append(base + index)
+        self._previous_space = previous_space
+        self._tail_positions = positions[-self._lookback:] if self._lookback else []
+
+        self._state, found = self.matcher.scan("".join(normalized), self._state)
+        patterns, payloads = self.matcher.patterns, self.matcher.payloads
+        for end, pattern_id in found:
+            kind, label = payloads[pattern_id]
+            end += carried
+            hit = {"kind": kind, "label": label, "pattern": patterns[pattern_id],
+                   "start": positions[end - len(patterns[pattern_id])], "end": positions[end - 1] + 1}
+            self.hits.append(hit)
+            if kind in self.stop_kinds and self.stop_hit is None:
+                self.stop_hit = hit
+        return self.stop_hit
+
+    def pending_start(self):
+        """
+        Offset in self.text where a match still in progress starts, or
+        len(self.text) if there is none. No later hit starts before it.
+        """
+        depth = self.matcher.prefix_length(self._state)
+        return self._tail_positions[-depth] if depth else self._length
+
+    def safe_text(self):
+        """
+        The generated text with anything from the stopping hit onwards removed.
+        Crisis hits drop the whole sentence they occur in; hits of any other
+        kind are cut right at the match.
+        """
+        text = self.text
+        hit = self.stop_hit
+        if hit is None:
+            return text
+        if hit["kind"] != "crisis":
+            return text[:hit["start"]]
+        return text[:sentence_start(text, hit["start"])]
+
+
+# Turn markers and template artifacts that end a generated reply
+DEFAULT_STOP_SEQUENCES = ("<|", "</", "[/", "<&", "User:", "Therapist:", "CLINICAL ASSESSMENT", "QUALITY VERIFICATION", "###")
+
+_stop_matchers = {}
+
+
+def compile_stop_sequences(stop_sequences):
+    """Build (or reuse) an exact, case-sensitive matcher for stop sequences."""
+    key = tuple(stop_sequences)
+    matcher = _stop_matchers.get(key)
+    if matcher is None:
+        matcher = AhoCorasickMatcher()
+        for sequence in key:
+            matcher.add(sequence, ("stop", sequence))
+        matcher.build()
+        with _registry_lock:
+            matcher = _stop_matchers.setdefault(key, matcher)
+    return matcher
+
+
+class StopSequenceScanner:
+    """
+    Watches generated text for stop sequences such as the next "User:" turn.
+
+    Same interface as StreamingSafetyScanner, but matching is exact and
+    case-sensitive (like `sequence in text`), so only the literal markers stop
+    generation and ordinary prose never does. Sequences split across chunks
+    are found by resuming the matcher state.
+    """
+
+    def __init__(self, stop_sequences=DEFAULT_STOP_SEQUENCES):
+        self.matcher = compile_stop_sequences(stop_sequences)
+        self.reset()
+
+    def reset(self):
+        self._state = 0
+        self._chunks = []
+        self._length = 0
+        self.stop_hit = None
+
+    @property
+    def stopped(self):
+        return self.stop_hit is not None
+
+    @property
+    def text(self):
+        return "".join(self._chunks)
+
+    def feed(self, chunk):
+        """Scan the next piece of generated text; returns the stopping hit (as StreamingSafetyScanner) or None."""
+        if self.stop_hit is not None or not chunk:
+            return self.stop_hit
+        base = self._length
+        self._chunks.append(chunk)
+        self._length += len(chunk)
+        self._state, found = self.matcher.scan(chunk, self._state)
+        if found:
+            # Cut at the earliest starting sequence, as splitting on each one in turn would
+            patterns = self.matcher.patterns
+            start, end, pattern_id = min((base + end - len(patterns[pid]), base + end, pid) for end, pid in found)
+            self.stop_hit = {"kind": "stop", "label": patterns[pattern_id], "pattern": patterns[pattern_id],
+                             "start": start, "end": end}
+        return self.stop_hit
+
+    def safe_text(self):
+        """The generated text up to (not including) the stop sequence."""
+        text = self.text
+        return text if self.stop_hit is None else text[:self.stop_hit["start"]]
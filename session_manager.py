@@ -0,0 +1,156 @@
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+from conversation_tracker import ConversationStateTracker
+
+# Rough fixed footprint of a session (tracker, deques, lock) on top of its stored text
+_SESSION_OVERHEAD_BYTES = 4096
+
+
+class ConversationSession:
+    """
+    Lightweight state of one user's conversation: the turns used as prompt
+    history, the analyses of recent messages and the running emotional state.
+    The model, tokenizer and engines are shared by all sessions and live on
+    UltimateGenerationEngine.
+
+    `lock` serializes the turns of this session; different sessions run
+    concurrently. It is a plain Lock, so a streaming turn may release it
+    from another thread than the one that acquired it. Crisis turns do not
+    wait for it: remember() and turns() take a separate short lock, so a
+    crisis turn can be recorded while a generation is still running.
+
+    `pins` counts the turns using the session (see SessionManager.get());
+    a pinned session is never evicted.
+    """
+
+    def __init__(self, session_id, memory_turns=10, analysis_history=10):
+        self.session_id = session_id
+        self.memory = deque(maxlen=memory_turns)
+        self.analyses = deque(maxlen=analysis_history)
+        self.state = ConversationStateTracker()
+        self.lock = threading.Lock()
+        self._record_lock = threading.Lock()
+        self.pins = 0
+        self.created = self.last_used = time.monotonic()
+        self.nbytes = _SESSION_OVERHEAD_BYTES
+
+    def remember(self, user_input, response, analysis=None):
+        """
+        Record a finished turn, fold its analysis into the emotional state and
+        refresh the size estimate. Turns that are never remembered (e.g.
+        cancelled ones) leave no trace in the session.
+        """
+        with self._record_lock:
+            self.memory.append({'user': user_input, 'assistant': response})
+            if analysis is not None:
+                self.analyses.append(analysis)
+                self.state.update(analysis)
+            self.nbytes = _SESSION_OVERHEAD_BYTES + sum(
+                sys.getsizeof(turn['user']) + sys.getsizeof(turn['assistant']) for turn in self.memory)
+
+    def turns(self):
+        """A copy of the remembered turns, oldest first."""
+        with self._record_lock:
+            return list(self.memory)
+
+
+class SessionManager:
+    """
+    Conversation sessions keyed by session id (e.g. Gradio's session hash).
+
+    get() returns the session for an id, creating it on first use. Sessions
+    are dropped when idle for longer than idle_ttl seconds, and least recently
+    used first when there are more than max_sessions or they hold more than
+    max_bytes together. Sessions that are pinned or whose lock is held (a
+    turn in progress) are never evicted. on_evict(session_id) is called for every dropped session,
+    so per-session caches elsewhere can be released too.
+    """
+
+    def __init__(self, max_sessions=1000, idle_ttl=3600, max_bytes=64 << 20, memory_turns=10,
+                 on_evict=None):
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.max_bytes = max_bytes
+        self.memory_turns = memory_turns
+        self.on_evict = on_evict
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, session_id):
+        return session_id in self._sessions
+
+    @property
+    def nbytes(self):
+        return sum(session.nbytes for session in list(self._sessions.values()))
+
+    def get(self, session_id=None, pin=False):
+        """
+        Return the session for session_id (a new id if None), marking it as used.
+
+        With pin=True the session is also pinned in the same step, so it
+        cannot be evicted before the caller's turn takes its lock or records
+        the turn. Every pinned get() must be matched by an unpin().
+        """
+        session_id = session_id or uuid.uuid4().hex
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+            if session is None:
+                session = ConversationSession(session_id, self.memory_turns)
+            session.last_used = time.monotonic()
+            if pin:
+                session.pins += 1
+            self._sessions[session_id] = session
+            evicted = self._enforce_limits(keep=session_id)
+        self._notify(evicted)
+        return session
+
+    def unpin(self, session):
+        """Release a pin taken by get(pin=True), e.g. when the turn is over."""
+        with self._lock:
+            session.pins -= 1
+            session.last_used = time.monotonic()
+
+    def drop(self, session_id):
+        """Forget a session, e.g. when the user resets the conversation."""
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is not None:
+            self._notify([session_id])
+
+    def expire(self):
+        """Drop idle sessions now (get() also does this as it goes). Returns the dropped ids."""
+        with self._lock:
+            evicted = self._enforce_limits()
+        self._notify(evicted)
+        return evicted
+
+    def _enforce_limits(self, keep=None):
+        # Oldest first, since get() moves every session it returns to the end
+        evicted = []
+        now = time.monotonic()
+        total = sum(session.nbytes for session in self._sessions.values())
+        for session_id, session in list(self._sessions.items()):
+            over_limit = len(self._sessions) > self.max_sessions or total > self.max_bytes
+            idle = self.idle_ttl is not None and now - session.last_used > self.idle_ttl
+            if not over_limit and not idle:
+                break
+            if session_id == keep or session.pins or session.lock.locked():
+                continue
+            del self._sessions[session_id]
+            total -= session.nbytes
+            evicted.append(session_id)
+        self.evictions += len(evicted)
+        return evicted
+
+    def _notify(self, evicted):
+        if self.on_evict is not None:
+            for session_id in evicted:
+                self.on_evict(session_id)
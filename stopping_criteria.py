@@ -0,0 +1,110 @@
+import torch
+from transformers import StoppingCriteria
+
+from safety_scanner import sentence_start
+
+
+class SafetyStoppingCriteria(StoppingCriteria):
+    """
+    Streams each step's newly generated text into one or more scanners
+    (StreamingSafetyScanner, StopSequenceScanner) and stops generation as soon
+    as any of them reports unsafe content or a stop sequence. This also ends
+    generation below min_new_tokens, which only holds back the EOS token.
+
+    Detokenization is incremental: every step decodes only the tokens since
+    the last emitted text (plus the one before, for correct spacing), and
+    waits while a multi-byte character is still incomplete. The reply is
+    never re-decoded from the start, and all scanners share the decoded text.
+    """
+    def __init__(self, tokenizer, scanners, prompt_length):
+        self.tokenizer = tokenizer
+        self.scanners = scanners
+        self._prefix_offset = prompt_length
+        self._read_offset = prompt_length
+
+    def __call__(self, input_ids, scores, **kwargs):
+        ids = input_ids[0]
+        prefix_text = self.tokenizer.decode(ids[self._prefix_offset:self._read_offset], skip_special_tokens=True)
+        new_text = self.tokenizer.decode(ids[self._prefix_offset:], skip_special_tokens=True)
+        if len(new_text) > len(prefix_text) and not new_text.endswith("\ufffd"):
+            chunk = new_text[len(prefix_text):]
+            for scanner in self.scanners:
+                scanner.feed(chunk)
+            self._prefix_offset = self._read_offset
+            self._read_offset = len(ids)
+        stopped = any(scanner.stopped for scanner in self.scanners)
+        return torch.full((input_ids.shape[0],), stopped, dtype=torch.bool, device=input_ids.device)
+
+
+class CancellationCriteria(StoppingCriteria):
+    """
+    Stops generation once `event` (a threading.Event) is set, e.g. by an
+    async caller whose client has disconnected, so no further tokens are
+    generated for an abandoned request.
+    """
+    def __init__(self, event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+
+def stopped_text(scanners):
+    """
+    The generated text that can be kept after a stop: the shortest safe_text()
+    of the scanners that stopped, with the scanner that produced it. Returns
+    (None, None) if no scanner stopped.
+    """
+    stopped = [scanner for scanner in scanners if scanner.stopped]
+    if not stopped:
+        return None, None
+    scanner = min(stopped, key=lambda s: len(s.safe_text()))
+    return scanner.safe_text(), scanner
+
+
+class ReplyStream:
+    """
+    Turns the reply into displayable text while it is still being generated.
+
+    Used as the last scanner of a SafetyStoppingCriteria, after the scanners
+    that can stop generation, so every decoded chunk has already been checked
+    when it arrives. on_text(text) is called with the whole raw reply that is
+    safe to show so far. Text is released a word at a time, and a tail that
+    could still grow into a stop sequence is held back. A crisis hit drops
+    the whole sentence it occurs in, so while a scanner can stop on crisis
+    content only complete sentences are released, and none that a keyword
+    still being matched could reach into. Either way nothing shown is later
+    taken back. The stream never stops generation itself.
+    """
+    stopped = False
+
+    def __init__(self, scanners, stop_sequences, on_text):
+        self.scanners = scanners
+        self.stop_sequences = tuple(stop_sequences)
+        self.on_text = on_text
+        self._crisis_scanners = [s for s in scanners if "crisis" in getattr(s, "stop_kinds", ())]
+        self._chunks = []
+        self.visible = ""
+
+    def _partial_stop_length(self, text):
+        # Longest tail of text that is the beginning of a stop sequence
+        for length in range(min(max(map(len, self.stop_sequences), default=1) - 1, len(text)), 0, -1):
+            tail = text[-length:]
+            if any(sequence.startswith(tail) for sequence in self.stop_sequences):
+                return length
+        return 0
+
+    def feed(self, chunk):
+        self._chunks.append(chunk)
+        text, _ = stopped_text(self.scanners)
+        if text is None:
+            text = "".join(self._chunks)
+            text = text[:len(text) - self._partial_stop_length(text)]
+            if self._crisis_scanners:
+                pending = min(scanner.pending_start() for scanner in self._crisis_scanners)
+                text = text[:sentence_start(text, pending)]
+            else:
+                text = text[:max(text.rfind(" "), text.rfind("\n"), 0)]
+        if text != self.visible:
+            self.visible = text
+            self.on_text(text)
@@ -0,0 +1,94 @@
+import os
+import sys
+
+import pytest
+
+# The engines are top-level modules in the repository root
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+# Tokenizer files of the fine-tuned phi-2 adapter shipped with the project
+MODEL_DIR = os.path.join(REPO_ROOT, "CBT_UMESH_23112108", "CBT_UMESH",
+                         "Cognitive-Behavioral-Therapy-CBT-AI-agent-main", "model")
+
+KNOWLEDGE = [
+    "Cognitive restructuring means noticing an automatic thought and weighing the evidence for and against it.",
+    "Slow breathing, in for four counts and out for six, calms the body's stress response.",
+    "Behavioural activation schedules small, valued activities to lift low mood.",
+    "Grounding uses the senses to bring attention back to the present moment.",
+]
+
+
+class FakeRetriever:
+    """Stands in for RAGKnowledgeEngine: returns the first k of `documents` for any query."""
+
+    def __init__(self, *args, **kwargs):
+        self.documents = list(KNOWLEDGE)
+        self.queries = []
+
+    def retrieve_relevant_knowledge(self, query_text, k=3, query_embedding=None):
+        self.queries.append(query_text)
+        return [{"content": doc, "metadata": None} for doc in self.documents[:k]]
+
+
+@pytest.fixture(scope="session")
+def phi2_tokenizer():
+    transformers = pytest.importorskip("transformers")
+    return transformers.AutoTokenizer.from_pretrained(MODEL_DIR)
+
+
+@pytest.fixture(scope="session")
+def tiny_phi():
+    """A small randomly initialized model with phi-2's architecture and vocabulary."""
+    torch = pytest.importorskip("torch")
+    transformers = pytest.importorskip("transformers")
+    torch.manual_seed(0)
+    config = transformers.PhiConfig(vocab_size=51200, hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                                    num_attention_heads=4, max_position_embeddings=2048,
+                                    bos_token_id=50256, eos_token_id=50256)
+    return transformers.PhiForCausalLM(config).eval()
+
+
+@pytest.fixture
+def greedy(monkeypatch):
+    """Greedy decoding of a fixed, short length for every reply."""
+    import UltimateGenerationEngine as module
+    monkeypatch.setitem(module.GENERATION_SETTINGS, "do_sample", False)
+    monkeypatch.setitem(module.GENERATION_SETTINGS, "max_new_tokens", 12)
+    monkeypatch.setitem(module.GENERATION_SETTINGS, "min_new_tokens", 12)
+    return module.GENERATION_SETTINGS
+
+
+@pytest.fixture
+def make_engine(monkeypatch, tiny_phi, phi2_tokenizer):
+    """Factory for UltimateGenerationEngine on the tiny model, with FakeRetriever as the knowledge base."""
+    pytest.importorskip("chromadb")
+    import UltimateGenerationEngine as module
+    monkeypatch.setattr(module, "RAGKnowledgeEngine", FakeRetriever)
+    engines = []
+
+    def make(**kwargs):
+        engine = module.UltimateGenerationEngine(tiny_phi, phi2_tokenizer, **kwargs)
+        engines.append(engine)
+        return engine
+
+    yield make
+    for engine in engines:
+        for pool in (engine._stage_pool, engine._inference_pool):
+            if pool is not None:
+                pool.shutdown(wait=True)
+
+
+@pytest.fixture
+def generate_calls(monkeypatch, tiny_phi):
+    """Record the output ids of every model.generate call and whether it started from a cache."""
+    calls = []
+    generate = tiny_phi.generate
+
+    def recording_generate(*args, **kwargs):
+        outputs = generate(*args, **kwargs)
+        calls.append({"sequences": outputs.sequences.clone(), "cached": kwargs.get("past_key_values") is not None})
+        return outputs
+
+    monkeypatch.setattr(tiny_phi, "generate", recording_generate)
+    return calls
@@ -0,0 +1,36 @@
+from benchmark_engines import compare
+
+
+def _report(**benchmarks):
+    return {"results": {"cbt_500": benchmarks}}
+
+
+def _result(p50, p99=None, rate=None, alloc=100.0):
+    return {"messages_per_sec": rate or round(1e6 / p50, 1), "p50_us": p50, "p99_us": p99 or 2 * p50,
+            "peak_alloc_bytes_per_message": alloc}
+
+
+def test_sub_microsecond_noise_is_not_a_regression():
+    baseline = _report(select_strategy=_result(0.3))
+    regressions, warnings = compare(_report(select_strategy=_result(0.57)), baseline)
+    assert regressions == [] and warnings == []
+
+
+def test_real_slowdown_is_a_regression():
+    baseline = _report(screen_message=_result(17.5))
+    regressions, _ = compare(_report(screen_message=_result(34.0)), baseline)
+    assert [line.split(":")[0] for line in regressions] == [
+        "cbt_500/screen_message messages_per_sec", "cbt_500/screen_message p50_us"]
+
+
+def test_p99_only_warns():
+    baseline = _report(screen_message=_result(17.5, p99=27.7))
+    regressions, warnings = compare(_report(screen_message=_result(17.5, p99=60.0)), baseline)
+    assert regressions == []
+    assert warnings == ["cbt_500/screen_message p99_us: 27.7 -> 60.0 (+117% worse)"]
+
+
+def test_allocation_growth_is_a_regression():
+    baseline = _report(select_strategy=_result(0.3, alloc=64.0))
+    regressions, _ = compare(_report(select_strategy=_result(0.3, alloc=151.0)), baseline)
+    assert regressions == ["cbt_500/select_strategy peak_alloc_bytes_per_message: 64.0 -> 151.0 (+136% worse)"]
@@ -0,0 +1,26 @@
+import pytest
+
+from emotional_intelligence_engine import EmotionalIntelligenceEngine, load_patterns
+
+SPEC = load_patterns()
+
+
+@pytest.fixture(scope="module")
+def ei_engine():
+    return EmotionalIntelligenceEngine(cache_size=0)
+
+
+@pytest.mark.parametrize("distortion,pattern", [
+    (distortion, pattern) for distortion, patterns in SPEC["cognitive_distortions"].items() for pattern in patterns])
+def test_every_distortion_pattern_matches(ei_engine, distortion, pattern):
+    text = f"Honestly,  {pattern.upper()} and that is how it goes."
+    assert distortion in ei_engine.analyze_emotional_state(text).cognitive_distortions
+    batch = ei_engine.analyze_emotional_states([text])
+    assert batch["distortion_flags"][0, batch["distortions"].index(distortion)]
+
+
+def test_mixed_case_patterns_match():
+    ei = EmotionalIntelligenceEngine(cache_size=0)
+    assert ei.analyze_emotional_state("I caused all of this.").has_distortion("personalization")
+    assert ei.analyze_emotional_state("i'm responsible for everything").has_distortion("personalization")
+    assert ei.analyze_emotional_state("I am useless").has_distortion("labeling")
@@ -0,0 +1,176 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+SESSION_ID = "stream-session"
+CRISIS_MESSAGE = "I can't do this anymore, I want to die."
+
+
+def _wait_unlocked(session, timeout=30):
+    assert session.lock.acquire(timeout=timeout), "session still locked"
+    session.lock.release()
+
+
+@pytest.mark.parametrize("drop", ["close", "garbage_collect"])
+def test_dropping_the_stream_stops_generation(make_engine, greedy, generate_calls, drop):
+    greedy["max_new_tokens"] = greedy["min_new_tokens"] = 400
+    engine = make_engine()
+    session = engine.sessions.get(SESSION_ID)
+
+    stream = engine.generate_master_response_stream("I've been feeling low all week.", session_id=SESSION_ID)
+    assert next(stream)
+    if drop == "close":
+        stream.close()
+    else:
+        del stream
+
+    _wait_unlocked(session)
+    generated = generate_calls[-1]["sequences"].shape[1] - engine.latency_log["prompt_tokens"][-1]
+    assert generated < 400
+    assert len(session.memory) == 0 and session.state.turns == 0
+
+    # The session is free for the next turn
+    greedy["max_new_tokens"] = greedy["min_new_tokens"] = 12
+    replies = list(engine.generate_master_response_stream("Still here.", session_id=SESSION_ID))
+    assert replies and len(session.memory) == 1
+
+
+def test_cancelled_agenerate_leaves_no_trace(make_engine, greedy, monkeypatch):
+    greedy["max_new_tokens"] = greedy["min_new_tokens"] = 400
+    engine = make_engine()
+    session = engine.sessions.get(SESSION_ID)
+    decoding = threading.Event()
+    decode_turn = engine._decode_turn
+
+    def signalling_decode_turn(*args, **kwargs):
+        decoding.set()
+        return decode_turn(*args, **kwargs)
+
+    monkeypatch.setattr(engine, "_decode_turn", signalling_decode_turn)
+
+    async def cancel_while_decoding():
+        task = asyncio.ensure_future(engine.agenerate(SESSION_ID, "I've been feeling low all week."))
+        while not decoding.is_set():
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel_while_decoding())
+    _wait_unlocked(session)
+    assert len(session.memory) == 0 and len(session.analyses) == 0
+    assert session.state.turns == 0 and session.state.sentiment_ewma is None
+
+    greedy["max_new_tokens"] = greedy["min_new_tokens"] = 12
+    asyncio.run(engine.agenerate(SESSION_ID, "Still here."))
+    assert len(session.memory) == 1 and session.state.turns == 1
+
+
+@pytest.mark.parametrize("path", ["generate", "stream", "agenerate"])
+def test_crisis_message_does_not_wait_for_a_running_turn(make_engine, greedy, monkeypatch, path):
+    engine = make_engine()
+    session = engine.sessions.get(SESSION_ID)
+    decoding, release = threading.Event(), threading.Event()
+    decode_turn = engine._decode_turn
+
+    def slow_decode_turn(*args, **kwargs):
+        decoding.set()
+        release.wait(30)
+        return decode_turn(*args, **kwargs)
+
+    monkeypatch.setattr(engine, "_decode_turn", slow_decode_turn)
+    running = threading.Thread(
+        target=engine.generate_master_response, args=("Work has been stressful.",), kwargs={"session_id": SESSION_ID})
+    running.start()
+    try:
+        assert decoding.wait(30)
+        assert session.lock.locked()
+
+        start = time.perf_counter()
+        if path == "generate":
+            response, _, strategy = engine.generate_master_response(CRISIS_MESSAGE, session_id=SESSION_ID)
+        elif path == "stream":
+            (response,) = list(engine.generate_master_response_stream(CRISIS_MESSAGE, session_id=SESSION_ID))
+            strategy = "crisis_intervention"
+        else:
+            response, _, strategy = asyncio.run(engine.agenerate(SESSION_ID, CRISIS_MESSAGE))
+        elapsed = time.perf_counter() - start
+
+        assert elapsed < 0.5
+        assert strategy == "crisis_intervention" and response in engine.crisis_responses.values()
+        assert session.lock.locked() and not release.is_set()
+    finally:
+        release.set()
+        running.join(30)
+    assert [turn["user"] for turn in session.turns()] == [CRISIS_MESSAGE, "Work has been stressful."]
+
+
+@pytest.mark.parametrize("path", ["generate", "stream", "agenerate"])
+def test_session_is_not_evicted_before_its_turn_takes_the_lock(make_engine, greedy, monkeypatch, path):
+    engine = make_engine(max_sessions=1)
+    screening, release = threading.Event(), threading.Event()
+    screen_message = engine.ei_engine.screen_message
+
+    def slow_screen_message(text):
+        if text == "Work has been stressful.":
+            screening.set()
+            release.wait(30)
+        return screen_message(text)
+
+    monkeypatch.setattr(engine.ei_engine, "screen_message", slow_screen_message)
+    if path == "generate":
+        turn = lambda: engine.generate_master_response("Work has been stressful.", session_id=SESSION_ID)
+    elif path == "stream":
+        turn = lambda: list(engine.generate_master_response_stream("Work has been stressful.", session_id=SESSION_ID))
+    else:
+        turn = lambda: asyncio.run(engine.agenerate(SESSION_ID, "Work has been stressful."))
+    running = threading.Thread(target=turn)
+    running.start()
+    try:
+        assert screening.wait(30)
+        session = engine.sessions._sessions[SESSION_ID]
+        # Another user arrives while the turn has its session but not yet its lock
+        engine.sessions.get("other-session")
+        assert SESSION_ID in engine.sessions
+    finally:
+        release.set()
+        running.join(30)
+    assert session.pins == 0
+    assert engine.sessions.get(SESSION_ID) is session
+    assert [turn["user"] for turn in session.turns()] == ["Work has been stressful."]
+
+
+def test_every_path_decodes_on_the_inference_worker(make_engine, greedy, monkeypatch, tiny_phi):
+    engine = make_engine()
+    active, overlaps, threads = [0], [], set()
+    generate = tiny_phi.generate
+    counter = threading.Lock()
+
+    def exclusive_generate(*args, **kwargs):
+        with counter:
+            active[0] += 1
+            overlaps.append(active[0])
+            threads.add(threading.current_thread().name)
+        try:
+            time.sleep(0.05)
+            return generate(*args, **kwargs)
+        finally:
+            with counter:
+                active[0] -= 1
+
+    monkeypatch.setattr(tiny_phi, "generate", exclusive_generate)
+    turns = [
+        lambda: engine.generate_master_response("Work has been stressful.", session_id="a"),
+        lambda: list(engine.generate_master_response_stream("I feel low.", session_id="b")),
+        lambda: asyncio.run(engine.agenerate("c", "I keep worrying.")),
+        lambda: engine.generate_master_response("My partner seems distant.", session_id="d"),
+    ]
+    running = [threading.Thread(target=turn) for turn in turns]
+    for thread in running:
+        thread.start()
+    for thread in running:
+        thread.join(60)
+    assert len(overlaps) == len(turns) and max(overlaps) == 1
+    assert all(name.startswith("inference") for name in threads)
@@ -0,0 +1,70 @@
+import random
+
+import torch
+
+from conftest import KNOWLEDGE
+
+HISTORY = [
+    {"user": "I've been so worried about work lately.", "assistant": "That sounds stressful. What worries you most?"},
+    {"user": "That I'll mess up the presentation.", "assistant": "What would it mean if it didn't go perfectly?"},
+]
+MESSAGE = "I keep thinking everyone will see I'm a failure."
+SESSION = [
+    "I've been so worried about work lately.",
+    "My manager criticised my report in front of everyone.",
+    "I couldn't sleep, I kept replaying the meeting.",
+    "My partner says I seem distant.",
+    "Maybe I should talk to my manager about it.",
+]
+
+
+def test_prefix_cache_greedy_outputs_identical(make_engine, greedy, generate_calls):
+    cached = make_engine(prefix_cache=True, session_cache=False)
+    plain = make_engine(prefix_cache=False, session_cache=False)
+    strategies = list(cached.strategy_engine.therapy_approaches)
+
+    for strategy in strategies:
+        cached._generate_reply(MESSAGE, HISTORY, strategy=strategy)
+        with_cache = generate_calls[-1]
+        plain._generate_reply(MESSAGE, HISTORY, strategy=strategy)
+        without_cache = generate_calls[-1]
+
+        assert with_cache["cached"] and not without_cache["cached"]
+        assert torch.equal(with_cache["sequences"], without_cache["sequences"]), strategy
+    assert cached.prefix_cache.hits == len(strategies)
+
+
+def _run_session(engine, generate_calls, knowledge_change_at):
+    engine.sessions.memory_turns = 3
+    sequences = []
+    for turn, message in enumerate(SESSION):
+        if turn == knowledge_change_at:
+            engine.rag_engine.documents = list(reversed(KNOWLEDGE))
+        random.seed(turn)
+        engine.generate_master_response(message, session_id="session")
+        sequences.append(generate_calls[-1]["sequences"])
+    return sequences
+
+
+def test_session_cache_greedy_outputs_identical(make_engine, greedy, generate_calls):
+    cached = make_engine(prefix_cache=True, session_cache=True)
+    plain = make_engine(prefix_cache=False, session_cache=False)
+    # Turn 3 retrieves different knowledge; at turn 4 the memory deque drops turn 0
+    with_cache = _run_session(cached, generate_calls, knowledge_change_at=3)
+    without_cache = _run_session(plain, generate_calls, knowledge_change_at=3)
+
+    for turn, (a, b) in enumerate(zip(with_cache, without_cache)):
+        assert torch.equal(a, b), turn
+
+    reuse = list(cached.latency_log["session_cache"])
+    assert reuse[0]["reused_tokens"] == 0
+    # No history yet the turn before, so only about the preamble is shared
+    assert 0 < reuse[1]["reused_tokens"] < reuse[1]["first_turn_end"]
+    # The earlier turns are reused, also when the retrieved knowledge changed
+    assert reuse[2]["reused_tokens"] >= reuse[2]["first_turn_end"]
+    assert reuse[3]["reused_tokens"] >= reuse[3]["first_turn_end"]
+    # Evicting the oldest turn rebases the cache to the preamble
+    assert 0 < reuse[4]["reused_tokens"] < reuse[4]["first_turn_end"]
+    summary = cached.session_cache_summary()
+    assert (summary["history_rate"], summary["prefix_rate"], summary["miss_rate"]) == (0.4, 0.4, 0.2)
+    assert len(plain.latency_log["session_cache"]) == 0
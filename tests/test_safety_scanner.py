@@ -0,0 +1,70 @@
+import pytest
+
+from emotional_intelligence_engine import EmotionalIntelligenceEngine
+from safety_scanner import DEFAULT_STOP_SEQUENCES, StopSequenceScanner
+from stopping_criteria import ReplyStream, stopped_text
+
+
+@pytest.fixture(scope="module")
+def ei_engine():
+    return EmotionalIntelligenceEngine()
+
+
+def _feed(scanner, text, size=3):
+    for start in range(0, len(text), size):
+        scanner.feed(text[start:start + size])
+    return scanner
+
+
+@pytest.mark.parametrize("text", [
+    "A clinical assessment can help you understand what is going on.",
+    "Some people write notes like user: today I felt calm.",
+    "Try these steps: breathe </ pause </ notice.",
+    "### Quality verification is not something you need to worry about.",
+])
+def test_prose_does_not_stop_the_reply(ei_engine, text):
+    scanner = _feed(ei_engine.output_scanner(), text)
+    assert not scanner.stopped
+    assert scanner.safe_text() == text
+
+
+def test_crisis_keyword_split_across_chunks_stops(ei_engine):
+    scanner = _feed(ei_engine.output_scanner(), "That sounds hard. Do you want  to DIE sometimes? Tell me more.")
+    assert scanner.stop_hit["kind"] == "crisis"
+    assert scanner.safe_text() == "That sounds hard."
+
+
+def test_role_label_is_a_stop_sequence():
+    scanner = _feed(StopSequenceScanner(), "That sounds hard.\nUser: I know")
+    assert scanner.stopped
+    assert scanner.safe_text() == "That sounds hard.\n"
+    assert not _feed(StopSequenceScanner(), "the user: note").stopped
+
+
+def _stream(scanners, chunks):
+    # Feed chunks as SafetyStoppingCriteria does, until a scanner stops generation
+    shown = []
+    stream = ReplyStream(scanners, DEFAULT_STOP_SEQUENCES, shown.append)
+    for chunk in chunks:
+        for scanner in scanners + [stream]:
+            scanner.feed(chunk)
+        if any(scanner.stopped for scanner in scanners):
+            break
+    return shown, stopped_text(scanners)[0]
+
+
+@pytest.mark.parametrize("chunks", [
+    ["You matter. ", "I hear that ", "you want to ", "die sometimes."],
+    ["That is hard.\nI want", " to\n", "die", " sometimes."],
+])
+def test_stream_never_takes_back_shown_text(ei_engine, chunks):
+    shown, final = _stream([ei_engine.output_scanner(), StopSequenceScanner()], chunks)
+    assert shown and final is not None
+    assert all(final.startswith(text) for text in shown), (shown, final)
+
+
+def test_stream_releases_whole_sentences_while_scanning_for_crisis(ei_engine):
+    shown, _ = _stream([ei_engine.output_scanner()], ["It sounds ", "like a hard week. ", "What helped ", "before?"])
+    assert shown == ["It sounds like a hard week.", "It sounds like a hard week. What helped before?"]
+    shown, _ = _stream([StopSequenceScanner()], ["It sounds ", "like a hard week. "])
+    assert shown == ["It sounds", "It sounds like a hard week."]
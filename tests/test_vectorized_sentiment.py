@@ -0,0 +1,74 @@
+import json
+import os
+import random
+
+import numpy as np
+import pytest
+
+from emotional_intelligence_engine import get_vectorized_scorer
+
+CORPUS_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cbt_500.jsonl")
+
+# One unit in the last digit VADER rounds to (plus float slack), see VectorizedSentimentScorer
+TOLERANCE = {"neg": 0.001, "neu": 0.001, "pos": 0.001, "compound": 0.0001}
+SLACK = 1e-9
+
+
+@pytest.fixture(scope="module")
+def scorer():
+    return get_vectorized_scorer()
+
+
+def _max_diffs(scorer, texts):
+    fast = scorer.score(texts)
+    exact = [scorer.analyzer.polarity_scores(text) for text in texts]
+    return {key: np.abs(fast[key] - np.array([scores[key] for scores in exact])) for key in TOLERANCE}
+
+
+def _fuzz_texts(scorer, n, seed=0):
+    rng = random.Random(seed)
+    lexicon = [word for word in scorer.analyzer.lexicon if word.isalpha()]
+    fillers = ["i", "feel", "the", "and", "not", "very", "but", "no", "so", "never", "really", "GREAT", "BAD",
+               "!", "?", "it", "isn't", "kind", "of", "extremely", "without", "doubt", "or", "nor"]
+    texts = []
+    for _ in range(n):
+        words = [rng.choice(lexicon) if rng.random() < 0.45 else rng.choice(fillers)
+                 for _ in range(rng.randint(1, 14))]
+        text = " ".join(words)
+        if rng.random() < 0.3:
+            text += rng.choice(["!", "!!", "?", "??", "...", "."])
+        texts.append(text)
+    return texts
+
+
+def test_cbt_500_matches_vader_exactly(scorer):
+    texts = []
+    with open(CORPUS_FILE) as f:
+        for line in f:
+            example = json.loads(line)
+            texts += [example["input"], example["output"]]
+    report = scorer.compare_with_vader(texts)
+    for key, result in report.items():
+        assert result["exact_fraction"] == 1.0, (key, result)
+        assert result["max_abs_diff"] == 0.0, (key, result)
+
+
+def test_fuzzed_texts_within_tolerance(scorer):
+    texts = _fuzz_texts(scorer, 5000)
+    for key, diff in _max_diffs(scorer, texts).items():
+        worst = int(diff.argmax())
+        assert diff[worst] <= TOLERANCE[key] + SLACK, (key, texts[worst], float(diff[worst]))
+
+
+@pytest.mark.parametrize("text", [
+    # A "but" clause with repeated equal valences, where VADER's rule
+    # rescales the wrong word (and the plain vectorized rule disagreed)
+    "genial but dynamitic",
+    "good good but good",
+    "happy but happy",
+    "I was happy but then sad and sad",
+    "bad but bad, really bad but fine",
+])
+def test_but_with_repeated_valences(scorer, text):
+    for key, diff in _max_diffs(scorer, [text]).items():
+        assert diff[0] <= TOLERANCE[key] + SLACK, (key, float(diff[0]))
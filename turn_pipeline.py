@@ -0,0 +1,76 @@
+import threading
+import time
+from concurrent.futures import Future
+
+
+class StageGraph:
+    """
+    The stages of one chat turn as a small dependency graph.
+
+    add(name, fn, *deps) registers a stage: fn is called with the results of
+    the stages named in deps, in that order, and is submitted to the executor
+    as soon as the last of them has finished. Stages without dependencies
+    start at once, so independent stages run concurrently. If a stage fails
+    or is cancelled, every stage depending on it fails with the same error.
+
+    Every stage has a concurrent.futures.Future (futures[name]), which a
+    caller can wait on, or await with asyncio.wrap_future. timings holds the
+    (start, end) of each finished stage in seconds since the graph was
+    created.
+    """
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.created = time.perf_counter()
+        self.futures = {}
+        self.timings = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, fn, *deps):
+        future = Future()
+        self.futures[name] = future
+        dependencies = [self.futures[dep] for dep in deps]
+        remaining = [len(dependencies)]
+
+        def launch():
+            try:
+                args = [dependency.result() for dependency in dependencies]
+            except BaseException as exc:
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(exc)
+                return
+            self.executor.submit(self._run, name, fn, args, future)
+
+        def dependency_done(_):
+            with self._lock:
+                remaining[0] -= 1
+                ready = remaining[0] == 0
+            if ready:
+                launch()
+
+        if not dependencies:
+            launch()
+        for dependency in dependencies:
+            dependency.add_done_callback(dependency_done)
+        return future
+
+    def result(self, name, timeout=None):
+        return self.futures[name].result(timeout)
+
+    def record(self, name, start, end=None):
+        """Add the timing of work done outside the graph (e.g. generation)."""
+        end = time.perf_counter() if end is None else end
+        self.timings[name] = (start - self.created, end - self.created)
+
+    def _run(self, name, fn, args, future):
+        if not future.set_running_or_notify_cancel():
+            return
+        start = time.perf_counter()
+        try:
+            result = fn(*args)
+        except BaseException as exc:
+            self.record(name, start)
+            future.set_exception(exc)
+        else:
+            self.record(name, start)
+            future.set_result(result)
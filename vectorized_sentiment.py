@@ -0,0 +1,268 @@
+import string
+
+import numpy as np
+from vaderSentiment.vaderSentiment import BOOSTER_DICT, C_INCR, N_SCALAR, NEGATE, SPECIAL_CASES
+
+# Vocabulary ids 0 and 1 are reserved for out-of-vocabulary tokens, with 1 marking
+# tokens that still negate because they contain "n't"
+_OOV, _OOV_NEGATION = 0, 1
+_PUNCTUATION = string.punctuation
+# Rules that depend on multi-word phrases ("the shit", "kind of" as a booster,
+# "least") are rare; texts containing them are scored by VADER itself
+_EXACT_ONLY = sorted([p for p in SPECIAL_CASES if " " in p] + [p for p in BOOSTER_DICT if " " in p] + ["least"])
+
+
+class VectorizedSentimentScorer:
+    """
+    Batch re-implementation of VADER's polarity_scores on NumPy arrays.
+
+    A whole batch is tokenized the way VADER's SentiText does it, tokens are
+    mapped to ids in a vocabulary index built from the VADER lexicon, booster
+    and negation lists, and the valence rules (capitalization emphasis,
+    boosters and negations in the three preceding words, "no", "but",
+    punctuation emphasis) are applied as array operations over every token of
+    the batch at once. compound/pos/neg/neu are then reduced per message.
+
+    Tolerance against SentimentIntensityAnalyzer.polarity_scores: messages
+    with emoji or with phrase rules ("least", idioms such as "the shit",
+    two-word boosters such as "kind of") are delegated to VADER and are exact,
+    as are messages with a "but" and repeated equal valences, where VADER's
+    own "but" handling can rescale the wrong word. Everything else may differ
+    by one unit in the last rounded digit (0.001 on pos/neg/neu, 0.0001 on
+    compound) because sums are accumulated in a different order.
+    compare_with_vader() measures this; over the inputs and outputs of
+    cbt_500.jsonl every message matches VADER exactly.
+    """
+
+    def __init__(self, analyzer):
+        self.analyzer = analyzer
+        # VADER replaces emoji character by character, so only single code points can match
+        self.emoji_codes = np.array(sorted(ord(e) for e in analyzer.emojis if len(e) == 1), dtype=np.uint32)
+
+        words = sorted(set(analyzer.lexicon) | set(BOOSTER_DICT) | set(NEGATE)
+                       | {"but", "no", "kind", "of", "never", "so", "this", "without", "doubt", "or", "nor"})
+        self.vocab = {word: index for index, word in enumerate(words, start=2)}
+        size = len(words) + 2
+
+        self.in_lexicon = np.zeros(size, dtype=bool)
+        self.valence = np.zeros(size, dtype=np.float64)
+        self.booster = np.zeros(size, dtype=np.float64)
+        self.is_booster = np.zeros(size, dtype=bool)
+        self.negation = np.zeros(size, dtype=bool)
+        self.negation[_OOV_NEGATION] = True
+        for word, index in self.vocab.items():
+            if word in analyzer.lexicon:
+                self.in_lexicon[index] = True
+                self.valence[index] = analyzer.lexicon[word]
+            if word in BOOSTER_DICT:
+                self.is_booster[index] = True
+                self.booster[index] = BOOSTER_DICT[word]
+            self.negation[index] = word in NEGATE or "n't" in word
+        self.ids = {word: self.vocab[word] for word in
+                    ("but", "no", "kind", "of", "never", "so", "this", "without", "doubt", "or", "nor")}
+
+    def _tokenize(self, texts):
+        # Split every text with str.split, then resolve each distinct raw token
+        # once (VADER's punctuation stripping, lowercasing, vocabulary lookup)
+        # and gather the per-token arrays with a single index map
+        flat, lengths = [], []
+        for text in texts:
+            tokens = text.split()
+            flat.extend(tokens)
+            lengths.append(len(tokens))
+        distinct = dict.fromkeys(flat)
+        vocab_get = self.vocab.get
+        distinct_ids, distinct_upper = [], []
+        for position, token in enumerate(distinct):
+            distinct[token] = position
+            stripped = token.strip(_PUNCTUATION)
+            if len(stripped) > 2:
+                token = stripped
+            lower = token.lower()
+            token_id = vocab_get(lower)
+            if token_id is None:
+                token_id = _OOV_NEGATION if "n't" in lower else _OOV
+            distinct_ids.append(token_id)
+            distinct_upper.append(token.isupper())
+        index = np.fromiter(map(distinct.__getitem__, flat), dtype=np.intp, count=len(flat))
+        return (np.array(distinct_ids, dtype=np.intp)[index], np.array(distinct_upper, dtype=bool)[index],
+                np.array(lengths, dtype=np.intp))
+
+    def score(self, texts):
+        """
+        Score a batch of texts. Returns a dict of float arrays keyed by
+        neg, neu, pos and compound, rounded like VADER's output.
+        """
+        texts = [text.strip() for text in texts]
+        n = len(texts)
+        ids, upper, lengths = self._tokenize(texts)
+        total_tokens = len(ids)
+        msg = np.repeat(np.arange(n), lengths)
+        starts = np.cumsum(lengths) - lengths
+
+        # VADER's is_cap_diff: some but not all words are ALL CAPS
+        upper_counts = np.bincount(msg, weights=upper, minlength=n)
+        cap_diff = ((lengths - upper_counts) > 0) & (upper_counts > 0)
+
+        # Only lexicon words (that are not boosters or the "kind" of "kind of")
+        # carry valence, so every rule below runs on that subset of tokens
+        candidates = np.flatnonzero(self.in_lexicon[ids] & ~self.is_booster[ids])
+        cand_pos = candidates - starts[msg[candidates]]
+        cand_last = cand_pos == lengths[msg[candidates]] - 1
+        next_ids = np.where(cand_last, _OOV, ids[np.minimum(candidates + 1, max(total_tokens - 1, 0))])
+        keep = ~((ids[candidates] == self.ids["kind"]) & (next_ids == self.ids["of"]))
+        idx, pos, next_ids = candidates[keep], cand_pos[keep], next_ids[keep]
+        tok = ids[idx]
+        row = msg[idx]
+
+        def before(k):
+            # ids of the word k positions earlier in the same message (_OOV if none)
+            return np.where(pos >= k, ids[np.maximum(idx - k, 0)], _OOV)
+
+        prev = {k: before(k) for k in (1, 2, 3)}
+        prev_is = lambda k, word: prev[k] == self.ids[word]
+
+        v = self.valence[tok].copy()
+        # "no" directly before a lexicon word carries no valence of its own
+        v[(tok == self.ids["no"]) & self.in_lexicon[next_ids]] = 0.0
+        no_before = prev_is(1, "no") | prev_is(2, "no") | (prev_is(3, "no") & (prev_is(1, "or") | prev_is(1, "nor")))
+        v = np.where(no_before, self.valence[tok] * N_SCALAR, v)
+        emphasized = upper[idx] & cap_diff[row]
+        v = np.where(emphasized, np.where(v > 0, v + C_INCR, v - C_INCR), v)
+
+        # Boosters and negations in the three preceding words, applied in order
+        damping = (1.0, 0.95, 0.9)
+        so_this_1 = prev_is(1, "so") | prev_is(1, "this")
+        so_this_2 = prev_is(2, "so") | prev_is(2, "this")
+        for k in (1, 2, 3):
+            prev_ids = prev[k]
+            active = (pos >= k) & ~self.in_lexicon[prev_ids]
+            prev_emphasized = (pos >= k) & upper[np.maximum(idx - k, 0)] & cap_diff[row]
+            boost = self.booster[prev_ids]
+            boost = np.where(v < 0, -boost, boost)
+            boost = boost + np.where(self.is_booster[prev_ids] & prev_emphasized, np.where(v > 0, C_INCR, -C_INCR), 0.0)
+            v = np.where(active, v + boost * damping[k - 1], v)
+
+            negated = self.negation[prev_ids]
+            if k == 1:
+                factor = np.where(negated, N_SCALAR, 1.0)
+            else:
+                if k == 2:
+                    emphasis = prev_is(2, "never") & so_this_1
+                    no_doubt = prev_is(2, "without") & prev_is(1, "doubt")
+                else:
+                    emphasis = (prev_is(3, "never") & so_this_2) | so_this_1
+                    no_doubt = prev_is(3, "without") & (prev_is(2, "doubt") | prev_is(1, "doubt"))
+                factor = np.where(emphasis, 1.25, np.where(no_doubt, 1.0, np.where(negated, N_SCALAR, 1.0)))
+            v = np.where(active, v * factor, v)
+
+        # "but": words before the first "but" count half, words after it 1.5x
+        but_idx = np.flatnonzero(ids == self.ids["but"])
+        no_but = np.iinfo(np.intp).max
+        first_but = np.full(n, no_but, dtype=np.intp)
+        np.minimum.at(first_but, msg[but_idx], but_idx - starts[msg[but_idx]])
+        has_but = first_but[row] != no_but
+        but_scale = np.where(pos < first_but[row], 0.5, np.where(pos > first_but[row], 1.5, 1.0))
+        ambiguous_but = self._ambiguous_but_rows(row[has_but], idx[has_but], v[has_but], but_scale[has_but], n)
+        v = np.where(has_but, v * but_scale, v)
+
+        punct, exact_only = self._text_features(texts)
+        exact_only |= ambiguous_but
+        total = np.bincount(row, weights=v, minlength=n)
+        total = np.where(total > 0, total + punct, np.where(total < 0, total - punct, total))
+        compound = np.clip(total / np.sqrt(total * total + 15), -1.0, 1.0)
+
+        # Every token without valence (including non-lexicon words) counts as neutral
+        pos_sum = np.bincount(row, weights=np.where(v > 0, v + 1, 0.0), minlength=n)
+        neg_sum = np.bincount(row, weights=np.where(v < 0, v - 1, 0.0), minlength=n)
+        neu_count = lengths - np.bincount(row, weights=(v != 0), minlength=n)
+        pos_sum, neg_sum = (np.where(pos_sum > -neg_sum, pos_sum + punct, pos_sum),
+                            np.where(pos_sum < -neg_sum, neg_sum - punct, neg_sum))
+        denom = pos_sum - neg_sum + neu_count
+        safe = np.where(denom == 0, 1.0, denom)
+        empty = lengths == 0
+        scores = {
+            "neg": np.where(empty, 0.0, np.round(np.abs(neg_sum / safe), 3)),
+            "neu": np.where(empty, 0.0, np.round(np.abs(neu_count / safe), 3)),
+            "pos": np.where(empty, 0.0, np.round(np.abs(pos_sum / safe), 3)),
+            "compound": np.where(empty, 0.0, np.round(compound, 4)),
+        }
+
+        for row in np.flatnonzero(exact_only):
+            exact = self.analyzer.polarity_scores(texts[row])
+            for key in scores:
+                scores[key][row] = exact[key]
+        return scores
+
+    def _ambiguous_but_rows(self, row, token, v, scale, n):
+        """
+        Mask of texts where VADER's "but" rule may rescale the wrong word. It
+        finds each valence with list.index(), so once two words of a message
+        hold an equal value (before or after rescaling) it can hit the earlier
+        one. Those texts are left to VADER.
+        """
+        nonzero = v != 0
+        rows = np.concatenate([row[nonzero], row[nonzero]])
+        tokens = np.concatenate([token[nonzero], token[nonzero]])
+        values = np.round(np.concatenate([v[nonzero], (v * scale)[nonzero]]), 6)
+        order = np.lexsort((tokens, values, rows))
+        rows, tokens, values = rows[order], tokens[order], values[order]
+        repeated = (rows[1:] == rows[:-1]) & (values[1:] == values[:-1]) & (tokens[1:] != tokens[:-1])
+        ambiguous = np.zeros(n, dtype=bool)
+        ambiguous[rows[1:][repeated]] = True
+        return ambiguous
+
+    def _text_features(self, texts):
+        """
+        Per-text punctuation emphasis and the mask of texts that must be scored
+        by VADER itself, computed over the whole batch joined into one string.
+        """
+        n = len(texts)
+        joined = "\n".join(texts)
+        offsets = np.cumsum([0] + [len(text) + 1 for text in texts[:-1]]) if n else np.zeros(0, dtype=np.intp)
+        codes = np.frombuffer(joined.encode("utf-32-le"), dtype=np.uint32)
+
+        def per_text(mask):
+            return np.bincount(np.searchsorted(offsets, np.flatnonzero(mask), side="right") - 1, minlength=n)
+
+        ep_count = np.minimum(per_text(codes == ord("!")), 4)
+        qm_count = per_text(codes == ord("?"))
+        qm_amplifier = np.where(qm_count > 3, 0.96, np.where(qm_count > 1, qm_count * 0.18, 0.0))
+        punct = ep_count * 0.292 + qm_amplifier
+
+        # Emoji are rewritten to their descriptions by VADER, and phrase rules are
+        # not vectorized; those texts are deferred to VADER itself
+        exact_only = np.zeros(n, dtype=bool)
+        lowered = joined.lower()
+        if len(lowered) == len(joined):
+            phrase_starts = []
+            for phrase in _EXACT_ONLY:
+                start = lowered.find(phrase)
+                while start != -1:
+                    phrase_starts.append(start)
+                    start = lowered.find(phrase, start + 1)
+            exact_only[np.searchsorted(offsets, phrase_starts, side="right") - 1] = True
+        else:
+            # Lowercasing changed some character's length; offsets no longer line up
+            exact_only[:] = [any(phrase in text.lower() for phrase in _EXACT_ONLY) for text in texts]
+        non_ascii = codes > 127
+        emoji = np.zeros(len(codes), dtype=bool)
+        emoji[non_ascii] = np.isin(codes[non_ascii], self.emoji_codes)
+        exact_only |= per_text(emoji) > 0
+        return punct, exact_only
+
+    def compare_with_vader(self, texts):
+        """
+        Parity check against per-text VADER. Returns, per score key, the
+        maximum absolute difference and the fraction of texts that match exactly.
+        """
+        texts = list(texts)
+        fast = self.score(texts)
+        exact = [self.analyzer.polarity_scores(text) for text in texts]
+        report = {}
+        for key in fast:
+            reference = np.array([scores[key] for scores in exact])
+            diff = np.abs(fast[key] - reference)
+            report[key] = {"max_abs_diff": float(diff.max()) if len(texts) else 0.0,
+                           "exact_fraction": float(np.mean(diff < 1e-9)) if len(texts) else 1.0}
+        return report